@@ -0,0 +1,67 @@
+"""
+Benchmark MaskSet against testing every mask with fnmatch.
+
+Run from the root directory:
+python -m benchmarks.hostmask
+"""
+
+import fnmatch
+import random
+import string
+import time
+
+from utils.protocol.irc.hostmask import MaskSet, irc_lower
+
+
+def random_word(length):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_masks(count):
+    masks = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            masks.append(f'*!*@{random_word(8)}.{random_word(6)}.com')
+        elif kind == 1:
+            masks.append(f'*!*@*.{random_word(10)}.net')
+        elif kind == 2:
+            masks.append(f'{random_word(8)}!*@*')
+        else:
+            masks.append(f'{random_word(6)}!{random_word(5)}@{random_word(8)}.org')
+    masks.append('*!*evil*@*')  # Needs the combined fallback regex.
+    return masks
+
+
+def make_hostmasks(count):
+    return [f'{random_word(8)}!{random_word(5)}@{random_word(6)}.{random_word(8)}.net' for _ in range(count)]
+
+
+def bench(masks, hostmasks):
+    started = time.perf_counter()
+    naive = [next((m for m in masks if fnmatch.fnmatchcase(irc_lower(h), irc_lower(m))), None) for h in hostmasks]
+    naive_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    maskset = MaskSet(masks)
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    indexed = [maskset.match(h) for h in hostmasks]
+    indexed_time = time.perf_counter() - started
+
+    assert [m is None for m in naive] == [m is None for m in indexed]
+    return naive_time, build_time, indexed_time
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    hostmasks = make_hostmasks(2000)
+    print(f'{"masks":>8} {"fnmatch":>12} {"build":>12} {"MaskSet":>12} {"per line":>12}')
+    for count in [10, 100, 1000, 5000]:
+        masks = make_masks(count)
+        # Make a tenth of the lines match one of the masks.
+        hostmasks[::10] = [m.replace('*', 'x').upper() for m in random.choices(masks, k=len(hostmasks[::10]))]
+        naive_time, build_time, indexed_time = bench(masks, hostmasks)
+        print(f'{count:>8} {naive_time * 1000:>10.1f}ms {build_time * 1000:>10.1f}ms '
+              f'{indexed_time * 1000:>10.1f}ms {indexed_time / len(hostmasks) * 1e6:>10.2f}us')
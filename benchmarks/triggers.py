@@ -0,0 +1,70 @@
+"""
+Benchmark TriggerSet against every module testing every trigger on its own.
+
+Run from the root directory:
+python -m benchmarks.triggers
+"""
+
+import random
+import re
+import string
+import time
+
+from utils.protocol.irc.triggers import TriggerSet
+
+
+def random_word(length):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_messages(count, keywords):
+    messages = []
+    for i in range(count):
+        words = [random_word(random.randint(2, 9)) for _ in range(random.randint(3, 20))]
+        if i % 20 == 0:
+            words.insert(random.randrange(len(words)), random.choice(keywords))
+        if i % 50 == 0:
+            words.append(f'https://{random_word(8)}.com/{random_word(5)}')
+        messages.append(' '.join(words))
+    return messages
+
+
+def bench(keywords, messages):
+    count = len(keywords)
+    regexes = [r'https?://\S+', r'\bv\d+\.\d+\b'] + [rf'\b{random_word(4)}\d+\b' for _ in range(count // 10)]
+    triggers = TriggerSet()
+    for keyword in keywords:
+        triggers.register(None, None, literal=keyword)
+    for regex in regexes:
+        triggers.register(None, None, regex=regex)
+
+    compiled = [re.compile(r, re.IGNORECASE) for r in regexes]
+    started = time.perf_counter()
+    naive = 0
+    for message in messages:
+        lowered = message.lower()
+        naive += sum(1 for keyword in keywords if keyword in lowered)
+        naive += sum(1 for regex in compiled if regex.search(message))
+    naive_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    triggers.compile()
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    combined = sum(len(triggers.match(message)) for message in messages)
+    combined_time = time.perf_counter() - started
+
+    assert naive == combined, (naive, combined)
+    return len(triggers), naive_time, build_time, combined_time
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    print(f'{"triggers":>8} {"one by one":>12} {"build":>12} {"TriggerSet":>12} {"per message":>12}')
+    for count in [10, 100, 1000, 5000]:
+        keywords = [random_word(random.randint(5, 10)) for _ in range(count)]
+        messages = make_messages(2000, keywords)  # Some messages contain a registered keyword.
+        total, naive_time, build_time, combined_time = bench(keywords, messages)
+        print(f'{total:>8} {naive_time * 1000:>10.1f}ms {build_time * 1000:>10.1f}ms '
+              f'{combined_time * 1000:>10.1f}ms {combined_time / len(messages) * 1e6:>10.2f}us')
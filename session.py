@@ -28,10 +28,41 @@ Optional:
 new_session.tls = <bool>            Set to a true boolean to use TLS.
 new_session.cert = <string>         Path to your *.pem file.
 new_session.channel = <string       Channel to join upon connect.
+new_session.autojoin = <list>       More channels to join upon connect, "#channel key" for channels with a key.
+                                    They are joined with as few lines as the server limits allow.
 new_session.alt_nick = <string>     Alternative nickname, in case the given nickname is already in use.
                                     If it happens with this option disabled, it will append some random
                                     numbers at the end of your nick.
-new_session.logging = <bool>        Enables or disabled logging. True by default.
+new_session.logging = <bool>        Enables or disables logging for this session. True by default.
+new_session.log_level = <string>    Log level for this session only, i.e. "INFO". DEBUG by default.
+new_session.log_file = <string>     Also write the log of this session to this file.
+new_session.raw_log = <string>      How to log raw traffic: "all" (default), "off", "sample" to log one in
+                                    every `raw_sample` (default 100) lines, or "errors" to only log the
+                                    last lines before an error.
+new_session.raw_sample = <int>      With raw_log = "sample", log one in every this many lines. 100 by default.
+new_session.record = <string>       Path to a file to record all inbound traffic to.
+                                    Recordings can be replayed offline with:
+                                    python session.py --replay <path> [--realtime]
+new_session.profiling = <bool>      Time every module call per event type. False by default.
+new_session.slow_threshold = <float>
+                                    Module calls taking longer than this many seconds are logged
+                                    when profiling is enabled. Defaults to 0.1.
+new_session.inbound_limit = <int>   Maximum number of received lines waiting to be processed. Defaults to 5000.
+new_session.shed_above = <int>      When more lines are waiting, PRIVMSG and NOTICE lines that are not commands
+                                    are shed. PING, NICK, QUIT, KICK etc. are never shed. Defaults to 500.
+new_session.shed_policy = <string>  "drop" to shed all low priority lines (default),
+                                    "sample" to keep one in every `shed_sample_rate` (default 10) lines.
+new_session.command_burst = <int>   Number of times a user may use the same command in a row. Defaults to 3.
+new_session.command_rate = <float>  After that, how many times per second. Defaults to 0.5.
+                                    Commands over the limit are ignored before any handler or module sees them.
+new_session.ignore = <list>         List of nick!user@host masks to ignore messages from.
+new_session.ping_interval = <int>   Seconds between PINGs to measure the lag to the server. Defaults to 60.
+new_session.stall_timeout = <int>   Reconnect when nothing is received for this many seconds. Defaults to 300.
+new_session.query_ttl = <int>       Seconds to cache the results of WHOIS, WHO, LIST and MODE queries. Defaults to 60.
+new_session.reconnect_delay = <int> Seconds to wait before reconnecting. Defaults to 10.
+new_session.state_check_interval = <int>
+                                    Seconds between logging memory usage and checking for stale users and channels.
+                                    Defaults to 3600.
 
 
 We have completed our IRC session instance, we can start it now:
@@ -43,6 +74,18 @@ Your new_session object will connect to the server,
 and if you specified a channel, it will join it once connected.
 An example can be found at the bottom of this file.
 
+To run many sessions, describe them in a fleet file instead (see utils/fleet.py and fleet.example.json),
+and start all of them at once with:
+
+python session.py --fleet fleet.json
+
+Several bots that only need to be on the same network can share a single connection.
+Attach them to a session before starting it, each with its own modules and command prefix:
+
+new_session.attach('shop', cmdprefix='.', modules=['shop.py'])
+
+See utils/multiplex.py. In a fleet file, give the entry an "upstream" with the name of the session to attach to.
+
 In the Session object, you can interact with your session by making it respond to events.
 The handle_event() method is where all the events are being processed.
 You can use this to write your own methods and modules.
@@ -68,10 +111,18 @@ You can open utils/protocol/irc/irc.py to add new event support in IRC.get_event
 An example IRC module can be found in the utils/protocol/irc/modules directory.
 """
 
+import argparse
+import sys
 import threading
+import time
 
+from utils import fleet
+from utils import recorder
 from utils.classes import AbstractClass
-from utils.logger import logging
+from utils.logger import SessionLogger
+from utils.offload import Offloader
+from utils.profiler import ModuleProfiler
+from utils.scheduler import Scheduler
 
 # Import your protocol.
 from utils.protocol.irc import irc
@@ -83,11 +134,32 @@ class Session(AbstractClass, threading.Thread):
         self.active = 0
         self.events = []
         self.logging = 1
+        self.reconnecting = 0
+        self.recorder = None
+        self.logical_sessions = []  # Other bots sharing this connection, see utils/multiplex.py.
+        self.log = SessionLogger(self.name)  # Logging of this session only, see utils/logger.py.
+        self.recv_buffer = b''  # Incomplete line received from the socket.
+        self.offloader = Offloader(self)
+        self.profiler = ModuleProfiler(log=self.log)
+        self.scheduler = Scheduler(log=self.log)  # Timers for this session and its modules, run from the event loop.
         self.protocol = protocol(self)
-        logging.debug(f'Protocol for this session set: {self.protocol}')
+        self.log.debug(f'Protocol for this session set: {self.protocol}')
 
     def run(self):
         self.protocol.run()
+        delay = getattr(self, 'reconnect_delay', 10)
+        while self.reconnecting:
+            self.log.info(f'Reconnecting {self} in {delay} seconds...')
+            time.sleep(delay)
+            self.reconnecting = 0
+            self.protocol.reset()
+            try:
+                self.protocol.run()
+                delay = getattr(self, 'reconnect_delay', 10)
+            except OSError as ex:
+                self.log.error(f'Reconnecting failed: {ex}')
+                self.reconnecting = 1
+                delay = min(delay * 2, 300)
 
     def handle_event(self, event_queue):
         """
@@ -101,6 +173,12 @@ class Session(AbstractClass, threading.Thread):
                 
                 self.protocol.join(channel)             Join a channel.
                 self.protocol.part(channel)             Leave a channel.
+                self.protocol.join_many(channels)       Join or leave many channels, or change many modes
+                self.protocol.part_many(channels, reason=None)
+                self.protocol.mode_many(target, changes)
+                                                        with as few lines as the server limits allow.
+                                                        `changes` holds (mode, parameter) tuples,
+                                                        like ('+v', nick) or ('+m', None).
                 self.protocol.nick(newnick)             Change your nickname.
 
 
@@ -112,16 +190,41 @@ class Session(AbstractClass, threading.Thread):
                                                         This method is called from the AbstractClass instead of the
                                                         Protocol class, because different protocols use different
                                                         ways to communicate.
-                                                        
+                                                        Long messages are split to fit the line length limit,
+                                                        and `target` may be a list of targets.
+
+                self.notice(text, target=None)          Same as say(), but sends a notice.
+
+                self.offload(owner, func, *args, callback=None, errback=None, timeout=None)
+                                                        Run CPU-heavy work in a shared process pool, the result is
+                                                        passed to callback on this session's thread.
+                                                        See utils/offload.py.
+
+                self.attach(name, cmdprefix, modules=None)
+                                                        Run another bot with its own modules and command prefix
+                                                        on this connection. See utils/multiplex.py.
+
+                self.bus.subscribe(self, callback, session=None, channel=None, event=None)
+                                                        Receive events from any session on the shared event bus.
+                                                        See utils/eventbus.py.
+
+                self.protocol.queries.whois(nick, callback=None, errback=None)
+                                                        Ask the server about a user, returns a future and calls
+                                                        callback with the result. Also who(), list() and mode().
+                                                        See utils/protocol/irc/queries.py.
+
+                self.protocol.lag.lag()                 Current lag to the server in seconds, useful to throttle output.
+                                                        See utils/protocol/irc/lag.py.
+
                 self.quit()                             Disconnects from IRC and closes the session.
                 """
                 IRCEvent = irc.IRCEvent
 
                 if event == IRCEvent.PRIVMSG:
                     if str(self.event_target_obj) == self.nickname:
-                        logging.debug(f'I got a private message from: {self.event_user_obj}')
-                        logging.debug(f'All users: {self.users}')
-                        logging.debug(f'All channels: {self.channels}')
+                        self.log.debug(f'I got a private message from: {self.event_user_obj}')
+                        self.log.debug(f'All users: {self.users}')
+                        self.log.debug(f'All channels: {self.channels}')
 
                     if argument[0] == '!whoareyou':
                         self.say(self.nickname)
@@ -133,13 +236,24 @@ class Session(AbstractClass, threading.Thread):
                         self.quit('Byebye!')
 
                     if argument[0] == '!logging':
+                        # Only affects the logging of this session.
+                        # !logging on|off, !logging level <level>, !logging raw all|errors|off|sample [n]
                         if len(argument) > 1 and argument[1].lower() in ['on', 'off']:
                             if argument[1].lower() == 'on':
-                                logging.disable(False)
+                                self.log.set_enabled(True)
                                 self.say('Logging enabled.')
                             else:
-                                logging.disable()
+                                self.log.set_enabled(False)
                                 self.say('Logging disabled.')
+                        elif len(argument) > 2 and argument[1].lower() == 'level' \
+                                and argument[2].upper() in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+                            self.log.configure(level=argument[2])
+                            self.say(f'Log level set to {argument[2].upper()}.')
+                        elif len(argument) > 2 and argument[1].lower() == 'raw' \
+                                and argument[2].lower() in self.log.raw_modes:
+                            sample = int(argument[3]) if len(argument) > 3 and argument[3].isdigit() else None
+                            self.log.configure(raw_mode=argument[2].lower(), raw_sample=sample)
+                            self.say(f'Raw traffic logging: {self.log.raw_mode}.')
 
                     if argument[0] == '!listusers':
                         for u in self.users:
@@ -153,11 +267,79 @@ class Session(AbstractClass, threading.Thread):
                         self.say('Reloading all modules...')
                         for module in list(self.modules):
                             self.protocol.reload_module(module)
+                        for logical in self.logical_sessions:
+                            for module in list(logical.modules):
+                                self.protocol.reload_module(module, logical)
                         self.say('Done!')
 
                     if argument[0] == '!modules':
                         for m in self.modules:
                             self.say(m)
+                        for logical in self.logical_sessions:
+                            self.say(f'{logical.name} ({logical.cmdprefix}): {", ".join(m.__name__ for m in logical.modules)}')
+
+                    if argument[0] == '!profile':
+                        # !profile on|off|stats|reset, or !profile <seconds> to run cProfile.
+                        option = argument[1].lower() if len(argument) > 1 else 'stats'
+                        if option in ['on', 'off']:
+                            self.profiler.enabled = option == 'on'
+                            self.say(f'Module profiling {"enabled" if self.profiler.enabled else "disabled"}.')
+                        elif option == 'reset':
+                            self.profiler.reset()
+                            self.say('Profiling statistics cleared.')
+                        elif option.isdigit():
+                            target = self.event_target_obj
+                            if self.profiler.start_profile(int(option), self.scheduler,
+                                                           done=lambda path: self.say(f'Profile written to {path}', target)):
+                                self.say(f'Profiling for {option} seconds...')
+                            else:
+                                self.say('A profile is already running.')
+                        else:
+                            for line in self.profiler.report() or ['No statistics collected.']:
+                                self.say(line)
+
+                    if argument[0] == '!inbound':
+                        self.say(self.protocol.inbound.stats())
+
+                    if argument[0] == '!memory':
+                        # !memory, !memory prune, !memory modules, !memory trace on|off
+                        option = argument[1].lower() if len(argument) > 1 else ''
+                        diagnostics = self.protocol.diagnostics
+                        if option == 'prune':
+                            self.say(f'Removed {diagnostics.prune()} stale users.')
+                        elif option == 'trace' and len(argument) > 2 and argument[2].lower() in ['on', 'off']:
+                            if argument[2].lower() == 'on':
+                                diagnostics.start_tracing()
+                                self.say('Memory tracing enabled.')
+                            else:
+                                diagnostics.stop_tracing()
+                                self.say('Memory tracing disabled.')
+                        elif option == 'modules':
+                            usage = diagnostics.module_memory()
+                            if not usage:
+                                self.say('Memory tracing is disabled. Enable it with: !memory trace on')
+                            for name, size, count in usage:
+                                self.say(f'{name}: {size / 1024:.1f} KiB in {count} allocations')
+                        else:
+                            self.say(', '.join(f'{k}: {v}' for k, v in diagnostics.report().items()))
+                            problems = diagnostics.check()
+                            for problem, _ in problems[:5]:
+                                self.say(problem)
+                            if len(problems) > 5:
+                                self.say(f'... and {len(problems) - 5} more problems.')
+
+                    if argument[0] == '!lag':
+                        self.say(self.protocol.lag)
+
+                    if argument[0] == '!whois' and len(argument) > 1:
+                        target = self.event_target_obj
+                        self.protocol.queries.whois(argument[1],
+                                                    callback=lambda r: self.say(f"{r['nick']} is {r.get('ident')}@{r.get('host')} "
+                                                                                f"({r.get('realname')}) on {' '.join(r['channels'])}", target),
+                                                    errback=lambda ex: self.say(f'{argument[1]}: {ex}', target))
+
+                    if argument[0] == '!queries':
+                        self.say(self.protocol.queries.stats())
 
                     if argument[0] == '!raw':
                         self.sendline(' '.join(argument[1:]))
@@ -168,17 +350,35 @@ class Session(AbstractClass, threading.Thread):
         return '<Session>'
 
 
-server = "irc.provisionweb.org"
-port = 6697
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fleet', metavar='PATH', help='Start all sessions from a fleet file (JSON or TOML).')
+    parser.add_argument('--replay', metavar='PATH', help='Replay a traffic recording instead of connecting.')
+    parser.add_argument('--realtime', action='store_true', help='Replay at the original pace.')
+    args = parser.parse_args()
 
-new_session = Session(protocol=irc.IRC)
+    if args.replay:
+        replay_session = Session(protocol=irc.IRC)
+        replay_session.nickname = "replay"
+        recorder.replay(replay_session, args.replay, realtime=args.realtime)
+        sys.exit()
 
-new_session.nickname = "sif-???"
-# new_session.alt_nick = "alternative_nickname"
-new_session.server = server
-new_session.port = port
-new_session.tls = 1
-# new_session.cert = "/path/to/cert.pem"
-new_session.channel = "#bla"
+    if args.fleet:
+        fleet.launch(args.fleet, Session)
+        sys.exit()
 
-new_session.start()
+    server = "irc.provisionweb.org"
+    port = 6697
+
+    new_session = Session(protocol=irc.IRC)
+
+    new_session.nickname = "sif-???"
+    # new_session.alt_nick = "alternative_nickname"
+    new_session.server = server
+    new_session.port = port
+    new_session.tls = 1
+    # new_session.cert = "/path/to/cert.pem"
+    new_session.channel = "#bla"
+    # new_session.record = "logs/traffic.rec"
+
+    new_session.start()
@@ -8,60 +8,126 @@ import enum
 import ssl
 import socket
 
+from utils import multiplex
 from utils import protocol
-from utils.logger import logging
+from utils import recorder
+from utils.eventbus import EventBus
 
 
 class AbstractClass(threading.Thread):
     sessions = []
+    bus = EventBus()  # Shared by all sessions.
 
     def activate_session(self):
         """
         Main method of activating sessions with different protocols.
         """
-        logging.debug(f'Session activated for {self}')
         self.sessions.append(self)
         self.active = 1
+        self.profiler.enabled = getattr(self, 'profiling', self.profiler.enabled)
+        if hasattr(self, 'slow_threshold'):
+            self.profiler.slow_threshold = self.slow_threshold
+        self.log.session_name = self.name
+        self.log.set_enabled(self.logging)
+        self.log.configure(level=getattr(self, 'log_level', None), filename=getattr(self, 'log_file', None),
+                           raw_mode=getattr(self, 'raw_log', None), raw_sample=getattr(self, 'raw_sample', None))
+        self.log.debug(f'Session activated for {self}')
+        if getattr(self, 'record', None):
+            self.recorder = recorder.TrafficRecorder(self.record)
         self.protocol.conn_established() # Call conn_established() method on protocol object to trigger events.
         self._get_new_events()
-        logging.info('Stopped listening for events.')
+        self.log.info('Stopped listening for events.')
 
     def _get_new_events(self):
         while self.active:
+            # Every session runs its own loop, so only wait on our own socket and scheduler.
+            # The timeout is shortened when a scheduled job is due sooner.
             try:
-                read, write, error = select.select([s for s in self.sessions if s.active and s.sock.fileno() != -1], [], [], 10.0)
+                watch = [self.scheduler] + ([self] if self.sock.fileno() != -1 else [])
+                read, write, error = select.select(watch, [], [], self.scheduler.timeout(10.0))
             except Exception as ex:
-                logging.exception(ex)
+                self.log.exception(ex)
                 break  # Kill connection..
 
+            if self.scheduler in read:
+                self.scheduler.clear_wakeup()
+                read.remove(self.scheduler)
+
             for session in read:
-                if session.logging:
-                    logging.enable()
-                else:
-                    logging.disable()
                 try:
-                    recv = session.sock.recv(4096).decode('utf-8')
-                except UnicodeDecodeError:
-                    recv = session.sock.recv(4096).decode('latin-1')
+                    data = session.sock.recv(4096)
+                    if data:
+                        data = session._recv_available(data)
                 except (OSError, ConnectionResetError) as ex:
-                    logging.exception(ex)
+                    session.log.exception(ex)
                     session.quit()
                     continue
 
-                if not recv:
+                if not data:
                     session.quit()
                     continue
 
-                session.protocol.get_events(recv)
+                if session.recorder:
+                    session.recorder.write(data)
+                session.feed(data)
+
+            self.scheduler.run_pending()
+
+    def _recv_available(self, data, limit=65536):
+        """
+        Read everything that is already waiting on the socket, up to `limit` bytes.
+        When we fall behind, the whole backlog reaches the protocol's inbound queue at once,
+        which can then decide what to shed.
+        """
+        chunks = [data]
+        size = len(data)
+        while size < limit:
+            pending = isinstance(self.sock, ssl.SSLSocket) and self.sock.pending()
+            if not pending and not select.select([self.sock], [], [], 0)[0]:
+                break
+            data = self.sock.recv(4096)
+            if not data:
+                break  # Connection closed, the next recv() will notice.
+            chunks.append(data)
+            size += len(data)
+        return b''.join(chunks)
+
+    def feed(self, data):
+        """
+        Pass received bytes to the protocol. Only complete lines are decoded and passed on,
+        an incomplete last line is kept until the rest of it arrives.
+        """
+        data = self.recv_buffer + data
+        end = data.rfind(b'\n') + 1
+        self.recv_buffer = data[end:]
+        if end:
+            self.protocol.get_events(self.decode(data[:end]))
+
+    @staticmethod
+    def decode(data):
+        """
+        Decode as UTF-8. If that fails, only the lines that are not valid UTF-8 are decoded as latin-1.
+        """
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return '\n'.join(AbstractClass.decode_line(line) for line in data.split(b'\n'))
+
+    @staticmethod
+    def decode_line(line):
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            return line.decode('latin-1')
 
     def sendline(self, data):
         if not self.active:
             return
         try:
             self.sock.send(bytes(data + '\r\n', 'utf-8'))
-            logging.info(f'<< {data}')
+            self.log.raw('<<', data)
         except Exception as ex:
-            logging.exception(ex)
+            self.log.exception(ex)
             self.quit()
 
     def say(self, text, target=None):
@@ -72,8 +138,33 @@ class AbstractClass(threading.Thread):
         if str(self.protocol) == "IRC":
             self.protocol.say(text, target)
 
+    def notice(self, text, target=None):
+        if str(self.protocol) == "IRC":
+            self.protocol.notice(text, target)
+
+    def offload(self, owner, func, *args, callback=None, errback=None, timeout=None, **kwargs):
+        """
+        Run func(*args) in the shared process pool, the callback runs on this session's event loop.
+        See utils/offload.py.
+        """
+        return self.offloader.submit(owner, func, *args, callback=callback, errback=errback, timeout=timeout, **kwargs)
+
+    def attach(self, name, cmdprefix, modules=None):
+        """
+        Run another bot with its own modules and command prefix on this connection.
+        See utils/multiplex.py.
+        """
+        return multiplex.attach(self, name, cmdprefix, modules)
+
+    def reconnect(self, reason=None):
+        """
+        Close the connection and let the session connect again.
+        """
+        self.reconnecting = 1
+        self.quit(reason)
+
     def quit(self, reason=None):
-        self.protocol.quit()
+        self.protocol.quit(reason)
         if str(self.protocol) == "IRC" and self.connected:
             pass
         try:
@@ -81,13 +172,18 @@ class AbstractClass(threading.Thread):
         except:
             pass
         self.sock.close()
+        if self.recorder:
+            self.recorder.close()
         self.active = 0
         self.connected = 0
+        if not self.reconnecting:
+            self.bus.unsubscribe_owner(self)
+        self.scheduler.wakeup()  # Let the event loop notice we are no longer active.
         if self in self.sessions:
             self.sessions.remove(self)
         else:
-            logging.info(f'{self} not found in sessions list: {self.sessions}')
-        logging.info(f'Session {self} closed.')
+            self.log.info(f'{self} not found in sessions list: {self.sessions}')
+        self.log.info(f'Session {self} closed.')
 
     def fileno(self):
         return self.sock.fileno()
@@ -0,0 +1,114 @@
+"""
+In-process event bus between sessions.
+
+Every session publishes its events on the shared bus, under the topic (session, channel, event).
+Sessions (or their modules) can subscribe to any combination of these, None acting as a wildcard.
+Messages are queued per subscriber and delivered on the subscribing session's own event loop,
+so a slow destination never blocks the session that published the event.
+Queues are bounded; when one is full the oldest message is dropped and counted.
+
+A relay from one network to another, from a module in the destination session:
+
+def relay(message):
+    self.session.say(f'<{message.user}> {" ".join(message.data)}', '#destination')
+
+self.sub = self.session.bus.subscribe(self.session, relay, session=source_session,
+                                      channel='#source', event=IRCEvent.PRIVMSG)
+self.sub.cancel()
+"""
+
+import collections
+import itertools
+import threading
+
+BusMessage = collections.namedtuple('BusMessage', ['session', 'channel', 'event', 'user', 'data'])
+
+
+class Subscription:
+    def __init__(self, bus, owner, callback, topic, maxlen):
+        self.bus = bus
+        self.owner = owner  # Session on whose event loop the callback runs.
+        self.callback = callback
+        self.topic = topic
+        self.queue = collections.deque(maxlen=maxlen)
+        self.dropped = 0
+        self.scheduled = 0
+        self.lock = threading.Lock()
+
+    def put(self, message):
+        with self.lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(message)
+            if self.scheduled:
+                return
+            self.scheduled = 1
+        self.owner.scheduler.call_soon(self.drain)
+
+    def drain(self):
+        with self.lock:
+            messages = list(self.queue)
+            self.queue.clear()
+            self.scheduled = 0
+        for message in messages:
+            try:
+                self.callback(message)
+            except Exception as ex:
+                self.owner.log.exception(ex)
+
+    def cancel(self):
+        self.bus.unsubscribe(self)
+
+    def __repr__(self):
+        return f'<Subscription {self.topic} for {self.owner}: {len(self.queue)} queued, {self.dropped} dropped>'
+
+
+class EventBus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}  # (session, channel, event): [subscriptions]
+
+    def subscribe(self, owner, callback, session=None, channel=None, event=None, maxlen=256):
+        """
+        Subscribe to events. Leave session, channel or event to None to match any.
+        :param owner:       session whose event loop runs the callback
+        :param callback:    called with a BusMessage for every matching event
+        :param maxlen:      maximum number of queued messages before the oldest ones are dropped
+        :return:            Subscription object, call cancel() on it to unsubscribe
+        """
+        topic = (session, channel.lower() if channel else None, event)
+        subscription = Subscription(self, owner, callback, topic, maxlen)
+        with self.lock:
+            self.topics.setdefault(topic, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.topics.get(subscription.topic, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.topics.pop(subscription.topic, None)
+
+    def unsubscribe_owner(self, owner):
+        for subscription in [s for subs in list(self.topics.values()) for s in subs if s.owner is owner]:
+            self.unsubscribe(subscription)
+
+    def publish(self, session, channel, event, user=None, data=None):
+        """
+        Deliver an event to all matching subscribers. Only looks up the 8 topics
+        that can match, so the cost depends on the number of subscribers, not topics.
+        """
+        if not self.topics:
+            return
+        channel = channel.lower() if channel else None
+        message = BusMessage(session, channel, event, user, data)
+        with self.lock:
+            # A set, so events without a channel do not match the same topic twice.
+            topics = set(itertools.product((session, None), (channel, None), (event, None)))
+            matches = [subscription for topic in topics for subscription in self.topics.get(topic, ())]
+        for subscription in matches:
+            subscription.put(message)
+
+    def __repr__(self):
+        return f'<EventBus ({sum(len(s) for s in self.topics.values())} subscriptions)>'
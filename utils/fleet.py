@@ -0,0 +1,116 @@
+"""
+Declarative fleet configuration.
+
+Instead of setting attributes on every session in Python, a fleet file (JSON, or TOML on
+Python 3.11+) describes any number of sessions. Values under "defaults" apply to every session,
+every entry under "sessions" holds the same attributes you would otherwise set on a session.
+Module code is imported only once for the whole fleet.
+
+An entry with an "upstream" does not connect by itself, but runs as a logical session on the
+connection of the session with that name, see utils/multiplex.py. It only takes a "cmdprefix"
+and optionally a list of "modules" (defaults do not apply):
+
+{"name": "shop", "upstream": "example-org", "cmdprefix": ".", "modules": ["shop.py"]}
+
+{
+    "defaults": {"protocol": "irc", "port": 6697, "tls": 1},
+    "sessions": [
+        {"nickname": "sif-???", "server": "irc.example.org", "channel": "#bla"},
+        {"nickname": "sif-???", "server": "irc.example.net", "channel": "#foo", "port": 6667, "tls": 0}
+    ]
+}
+
+Start the fleet with:
+python session.py --fleet fleet.json
+"""
+
+import json
+import os
+
+from utils.logger import logging
+from utils.protocol.irc import irc
+from utils.settings.irc import check_settings, IRCSettingsError
+
+PROTOCOLS = {"irc": (irc.IRC, check_settings, IRCSettingsError)}
+
+
+class FleetError(Exception):
+    pass
+
+
+def read_config(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if os.path.splitext(path)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise FleetError("TOML fleet files require Python 3.11 or newer, use JSON instead.")
+        return tomllib.loads(data.decode('utf-8'))
+    return json.loads(data)
+
+
+def load_fleet(path, session_class):
+    """
+    Create all sessions described in the fleet file. All sessions are validated before any of them
+    is started, and all errors are reported at once.
+    :return: list of session objects, not started yet
+    """
+    config = read_config(path)
+    defaults = config.get('defaults', {})
+    if not config.get('sessions'):
+        raise FleetError(f"No sessions defined in {path}")
+
+    sessions, logical, errors = [], [], []
+    for idx, entry in enumerate(config['sessions']):
+        if 'upstream' in entry:
+            logical.append((entry.get('name', f"session {idx + 1}"), entry))
+            continue
+        settings = dict(defaults, **entry)
+        name = settings.pop('name', f"session {idx + 1}")
+        protocol = PROTOCOLS.get(str(settings.pop('protocol', 'irc')).lower())
+        if not protocol:
+            errors.append(f"{name}: unknown protocol, choose one of: {', '.join(PROTOCOLS)}")
+            continue
+        protocol_class, check, settings_error = protocol
+
+        session = session_class(protocol=protocol_class)
+        for attr, value in settings.items():
+            setattr(session, attr, value)
+        try:
+            check(session)
+        except settings_error as ex:
+            errors.append(f"{name}: {ex}")
+            session.sock.close()
+            continue
+        session.name = name
+        sessions.append(session)
+
+    for name, entry in logical:
+        upstream = next((s for s in sessions if s.name == entry['upstream']), None)
+        if not upstream:
+            errors.append(f"{name}: unknown upstream session {entry['upstream']!r}")
+        elif not isinstance(entry.get('cmdprefix'), str) or not entry['cmdprefix']:
+            errors.append(f"{name}: a logical session needs a cmdprefix")
+        elif not isinstance(entry.get('modules', []), list):
+            errors.append(f"{name}: modules must be a list of module files")
+        elif not errors:
+            try:
+                upstream.attach(name, entry['cmdprefix'], entry.get('modules'))
+            except ValueError as ex:
+                errors.append(f"{name}: {ex}")
+
+    if errors:
+        raise FleetError(f"Invalid fleet configuration in {path}:\n" + '\n'.join(errors))
+    return sessions
+
+
+def launch(path, session_class):
+    """
+    Load a fleet file and start all of its sessions.
+    """
+    sessions = load_fleet(path, session_class)
+    logging.info(f'Starting {len(sessions)} sessions from {path}')
+    for session in sessions:
+        session.start()
+    return sessions
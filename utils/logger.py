@@ -1,8 +1,10 @@
+import collections
 import logging
 import logging.handlers
 import time
 import datetime
 import os
+import sys
 
 W = '\033[0m'  # white (normal)
 R = '\033[31m'  # red
@@ -120,6 +122,100 @@ class EnhancedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
                     os.remove(f)
 
 
+class SessionLoggerBase(logging.Logger):
+    def setLevel(self, level):
+        logging.Logger.setLevel(self, level)
+        self._cache.clear()  # Not registered with the manager, so it does not clear our cache.
+
+    def findCaller(self, stack_info=False, stacklevel=1):
+        """
+        Like Logger.findCaller(), but also skips the frames of this file,
+        so records show the module that called the SessionLogger.
+        """
+        f = sys._getframe(1)
+        while f and os.path.normcase(f.f_code.co_filename) in (logging._srcfile, os.path.normcase(__file__)):
+            f = f.f_back
+        if not f:
+            return "(unknown file)", 0, "(unknown function)", None
+        return f.f_code.co_filename, f.f_lineno, f.f_code.co_name, None
+
+
+class SessionLogger(logging.LoggerAdapter):
+    """
+    Logger for a single session, with its own level and optional log file, so one session
+    can be traced without changing the logging of all other sessions.
+    Messages are prefixed with the session name and also go to the main log.
+
+    Raw traffic is logged with raw(), according to the raw mode:
+    all         Log every line.
+    sample      Log one in every `raw_sample` lines.
+    errors      Only keep the last `raw_buffer` lines in memory, and log them when an error is logged.
+    off         Do not log raw traffic.
+    """
+    raw_modes = ['all', 'sample', 'errors', 'off']
+
+    def __init__(self, name, level=logging.DEBUG):
+        logger = SessionLoggerBase(f'session.{name}')
+        logger.parent = logging.getLogger()  # Records also go to the main log handlers.
+        logging.LoggerAdapter.__init__(self, logger, {})
+        self.session_name = name
+        self.logger.setLevel(level)
+        self.handler = None
+        self.raw_mode = 'all'
+        self.raw_sample = 100
+        self.raw_count = 0
+        self.raw_lines = collections.deque(maxlen=50)
+
+    def configure(self, level=None, filename=None, raw_mode=None, raw_sample=None, raw_buffer=None):
+        if level is not None:
+            self.logger.setLevel(level if isinstance(level, int) else level.upper())
+        if filename and not self.handler:
+            self.handler = logging.FileHandler(filename, encoding='utf-8')
+            self.handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(module)s]: %(message)s',
+                                                        datefmt='%Y/%m/%d %H:%M:%S'))
+            self.logger.addHandler(self.handler)
+        if raw_mode is not None:
+            self.raw_mode = raw_mode
+        if raw_sample is not None:
+            self.raw_sample = max(1, raw_sample)
+        if raw_buffer is not None:
+            self.raw_lines = collections.deque(self.raw_lines, maxlen=raw_buffer)
+
+    def set_enabled(self, enabled):
+        self.logger.disabled = not enabled
+
+    def process(self, msg, kwargs):
+        return f'[{self.session_name}] {msg}', kwargs
+
+    def raw(self, direction, line):
+        """
+        Log a raw line. `direction` is ">>" for received and "<<" for sent lines.
+        """
+        mode = self.raw_mode
+        if mode == 'off':
+            return
+        if mode == 'errors':
+            self.raw_lines.append(f'{direction} {line}')
+            return
+        if mode == 'sample':
+            self.raw_count += 1
+            if self.raw_count % self.raw_sample:
+                return
+        if self.isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, f'{direction} {line}')
+
+    def log(self, level, msg, *args, **kwargs):
+        logging.LoggerAdapter.log(self, level, msg, *args, **kwargs)
+        if level >= logging.ERROR and self.raw_mode == 'errors' and self.raw_lines:
+            lines, self.raw_lines = list(self.raw_lines), collections.deque(maxlen=self.raw_lines.maxlen)
+            logging.LoggerAdapter.log(self, level, f'Last {len(lines)} raw lines before this error:')
+            for line in lines:
+                logging.LoggerAdapter.log(self, level, line)
+
+    def __repr__(self):
+        return f'<SessionLogger {self.session_name} ({logging.getLevelName(self.getEffectiveLevel())}, raw: {self.raw_mode})>'
+
+
 def initlogging():
     if not os.path.exists('logs'):
         os.mkdir('logs')
@@ -0,0 +1,73 @@
+"""
+Several bots on one connection.
+
+A logical session is a bot with its own modules and command prefix, that lives on the connection
+of a normal (upstream) session. Every line is parsed only once by the upstream session, and the
+resulting events are passed on to all of its logical sessions. Users, channels, the scheduler and
+everything else are shared with the upstream session, and say() goes out over its connection:
+
+shop = new_session.attach('shop', cmdprefix='.', modules=['shop.py'])
+
+Modules of a logical session are written like any other module. Commands are translated to the
+usual "!" prefix, so the modules of `shop` see ".price" as "!price", while "!price" itself belongs to
+the upstream session and is not passed on. `cmdprefix` may be longer than one character,
+i.e. "shop." to use "shop.price", but no prefix on a connection may start with another one.
+`modules` is a list of module files to load, all modules by default.
+"""
+
+
+class LogicalSession:
+    def __init__(self, upstream, name, cmdprefix):
+        self.__dict__['upstream'] = upstream  # Set first, __getattr__ relies on it.
+        self.name = name
+        self.cmdprefix = cmdprefix
+        self.modules = {}
+
+    def __getattr__(self, attr):
+        """
+        Everything not specific to this logical session comes from the upstream session.
+        """
+        return getattr(self.upstream, attr)
+
+    def handle_event(self, event_queue):
+        """
+        Called with the events for this logical session, before its modules are.
+        Override it to handle events without a module, like Session.handle_event().
+        """
+        pass
+
+    def load_modules(self, names=None):
+        for name in names if names is not None else self.protocol.module_files():
+            self.protocol.load_module(name, session=self)
+
+    def unload_modules(self):
+        for module in list(self.modules):
+            self.protocol.unload_module(module, session=self)
+
+    def __repr__(self):
+        return f'<LogicalSession "{self.name}" on {self.upstream!r}>'
+
+
+def attach(upstream, name, cmdprefix, modules=None):
+    """
+    Create a logical session on `upstream` and load its modules.
+    """
+    # With "!" and "!s", both sessions would take "!sup" as their command.
+    for prefix in [upstream.protocol.cmdprefix] + [s.cmdprefix for s in upstream.logical_sessions]:
+        if cmdprefix.startswith(prefix) or prefix.startswith(cmdprefix):
+            raise ValueError(f"Command prefix {cmdprefix!r} overlaps with {prefix!r}, already in use on {upstream}.")
+    logical = LogicalSession(upstream, name, cmdprefix)
+    upstream.logical_sessions.append(logical)
+    upstream.protocol.update_cmdprefixes()
+    logical.load_modules(modules)
+    upstream.log.info(f'{logical} attached with command prefix {cmdprefix!r}.')
+    return logical
+
+
+def detach(logical):
+    logical.unload_modules()
+    upstream = logical.upstream
+    if logical in upstream.logical_sessions:
+        upstream.logical_sessions.remove(logical)
+        upstream.protocol.update_cmdprefixes()
+    upstream.log.info(f'{logical} detached.')
@@ -0,0 +1,169 @@
+"""
+Offload CPU-heavy work to a process pool.
+
+Work done inside a module's run() method holds the GIL and stalls every session.
+Instead, a module can send a picklable function to a worker process that is shared
+by all sessions, and get the result back on its own session's event loop:
+
+def done(result):
+    self.session.say(f'The answer is {result}')
+
+self.session.offload(self, heavy_function, arg1, arg2, callback=done, errback=failed, timeout=30)
+
+`heavy_function` must be defined at the top level of a module, so it can be pickled.
+Every owner (usually the module object) may have `offload_limit` tasks running at once
+(an attribute of the owner, 2 if it has none), more tasks wait for a slot.
+On timeout the errback receives a TimeoutError and the late result is discarded.
+A worker process cannot be stopped halfway through a task, so a timed-out task keeps its slot
+and its worker until it really finishes, only then can the next waiting task of the owner start.
+
+Workers are started with forkserver (spawn where it is not available) instead of fork,
+so they do not inherit the sockets, locks and threads of the running sessions.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+from utils.logger import logging
+
+
+def _noop():
+    return os.getpid()
+
+
+class Task:
+    def __init__(self, owner, func, args, kwargs, callback, errback, timeout):
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.errback = errback
+        self.timeout = timeout
+        self.future = None
+        self.timer = None
+        self.finished = 0
+
+    def __repr__(self):
+        return f'<Task {getattr(self.func, "__name__", self.func)} for {self.owner}>'
+
+
+class Offloader:
+    executor = None  # Shared by all sessions.
+    max_workers = None  # Defaults to the number of CPUs.
+    lock = threading.Lock()
+
+    def __init__(self, session):
+        self.session = session
+        self.running = collections.Counter()  # Running tasks per owner.
+        self.waiting = collections.defaultdict(collections.deque)
+        self.tasks = set()  # Running tasks.
+
+    @classmethod
+    def get_executor(cls):
+        with cls.lock:
+            if not cls.executor:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                cls.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=cls.max_workers, mp_context=multiprocessing.get_context(method))
+                logging.info(f'Started process pool with {cls.executor._max_workers} workers.')
+            return cls.executor
+
+    @classmethod
+    def warm(cls):
+        """
+        Start all worker processes now, instead of on the first task.
+        """
+        executor = cls.get_executor()
+        for future in [executor.submit(_noop) for _ in range(executor._max_workers)]:
+            future.result()
+
+    @classmethod
+    def shutdown(cls):
+        with cls.lock:
+            if cls.executor:
+                cls.executor.shutdown(wait=False, cancel_futures=True)
+                cls.executor = None
+
+    def submit(self, owner, func, *args, callback=None, errback=None, timeout=None, **kwargs):
+        """
+        Run func(*args, **kwargs) in the process pool.
+        :param owner:       object the concurrency limit applies to, usually the module object
+        :param callback:    called with the result, on this session's event loop
+        :param errback:     called with the exception if the task failed or timed out
+        :param timeout:     seconds after which the task is given up on
+        :return:            Task object
+        """
+        task = Task(owner, func, args, kwargs, callback, errback, timeout)
+        if self.running[owner] < getattr(owner, 'offload_limit', 2):
+            self._start(task)
+        else:
+            self.session.log.debug(f'Concurrency limit reached for {owner}, {task} is waiting.')
+            self.waiting[owner].append(task)
+        return task
+
+    def _start(self, task):
+        self.running[task.owner] += 1
+        self.tasks.add(task)
+        task.future = self.get_executor().submit(task.func, *task.args, **task.kwargs)
+        if task.timeout:
+            task.timer = self.session.scheduler.call_later(task.timeout, self._timeout, task)
+        # Done callbacks run in a pool thread, hand them over to the session's event loop.
+        task.future.add_done_callback(lambda future: self.session.scheduler.call_soon(self._done, task))
+
+    def _timeout(self, task):
+        if task.finished:
+            return
+        task.finished = 1
+        self.session.log.warning(f'{task} timed out after {task.timeout} seconds.')
+        task.future.cancel()  # Only works if it has not started yet, otherwise _done() frees the slot later.
+        self._deliver(task.errback, TimeoutError(f'{task} timed out after {task.timeout} seconds.'))
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.running[task.owner] -= 1
+        if not self.running[task.owner]:
+            del self.running[task.owner]
+        if self.waiting[task.owner]:
+            self._start(self.waiting[task.owner].popleft())
+        else:
+            del self.waiting[task.owner]
+
+        if task.finished:
+            return  # Timed out or cancelled, nobody is waiting for this result anymore.
+        task.finished = 1
+        if task.timer:
+            task.timer.cancel()
+        if task.future.cancelled():
+            return
+        exception = task.future.exception()
+        if exception:
+            self.session.log.error(f'{task} failed: {exception!r}')
+            self._deliver(task.errback, exception)
+        else:
+            self._deliver(task.callback, task.future.result())
+
+    def _deliver(self, callback, value):
+        if not callback:
+            return
+        try:
+            callback(value)
+        except Exception as ex:
+            self.session.log.exception(ex)
+
+    def cancel(self, owner):
+        """
+        Cancel all waiting tasks of `owner` and drop the results of its running tasks.
+        """
+        self.waiting.pop(owner, None)
+        for task in [task for task in self.tasks if task.owner is owner]:
+            task.finished = 1
+            task.future.cancel()
+            if task.timer:
+                task.timer.cancel()
+
+    def __repr__(self):
+        return f'<Offloader {sum(self.running.values())} running, {sum(map(len, self.waiting.values()))} waiting>'
@@ -0,0 +1,100 @@
+"""
+Instrumentation for module dispatch.
+
+When enabled, every call to a module's run() method is timed (wall clock and CPU time of the
+calling thread) and aggregated per module and per event type. Calls slower than
+`slow_threshold` seconds are logged together with the offending event.
+
+Set `session.profiling = 1` before starting a session to enable it from the start,
+or toggle it at runtime with the !profile command.
+
+A cProfile run of the session thread can be started for a number of seconds as well,
+the result is dumped to the logs directory and can be inspected with pstats or snakeviz.
+"""
+
+import cProfile
+import os
+import time
+
+from utils.logger import logging
+
+
+class ModuleProfiler:
+    def __init__(self, slow_threshold=0.1, log=logging):
+        self.enabled = 0
+        self.log = log  # The logger of the session, the root logger if there is none.
+        self.slow_threshold = slow_threshold
+        self.stats = {}  # (module name, event name): [calls, wall, cpu, max wall]
+        self.profile = None
+
+    @staticmethod
+    def module_name(callable):
+        return type(callable).__module__.split('.')[-1]
+
+    @staticmethod
+    def event_name(event):
+        return getattr(event[0], 'name', str(event[0]))
+
+    def run(self, callable, event, recv, *extra):
+        """
+        Calls callable.run(event, recv, *extra) and records how long it took.
+        """
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return callable.run(event, recv, *extra)
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            key = (self.module_name(callable), self.event_name(event))
+            entry = self.stats.get(key)
+            if not entry:
+                entry = self.stats[key] = [0, 0.0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+            if wall > entry[3]:
+                entry[3] = wall
+            if wall >= self.slow_threshold:
+                self.log.warning(f'Slow handler: {callable} took {wall * 1000:.1f}ms '
+                                f'({cpu * 1000:.1f}ms CPU) for event {event}: {" ".join(recv)}')
+
+    def report(self, limit=10):
+        """
+        Returns the `limit` most expensive module/event pairs as printable lines.
+        """
+        lines = []
+        for (module, event), (calls, wall, cpu, max_wall) in \
+                sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            lines.append(f'{module} {event}: {calls} calls, {wall * 1000:.1f}ms wall, {cpu * 1000:.1f}ms CPU, '
+                         f'avg {wall / calls * 1000:.2f}ms, max {max_wall * 1000:.1f}ms')
+        return lines
+
+    def reset(self):
+        self.stats = {}
+
+    def start_profile(self, seconds, scheduler, done=None):
+        """
+        Run cProfile on the calling thread for `seconds` seconds.
+        :param done:    optional callback, called with the path of the profile dump
+        :return:        False if a profile is already running
+        """
+        if self.profile:
+            return False
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        scheduler.call_later(seconds, self.stop_profile, done)
+        self.log.info(f'Started cProfile for {seconds} seconds.')
+        return True
+
+    def stop_profile(self, done=None):
+        if not self.profile:
+            return
+        self.profile.disable()
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        path = f'logs/profile-{time.strftime("%Y%m%d-%H%M%S")}.prof'
+        self.profile.dump_stats(path)
+        self.profile = None
+        self.log.info(f'Profile written to {path}')
+        if done:
+            done(path)
+        return path
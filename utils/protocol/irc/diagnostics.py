@@ -0,0 +1,133 @@
+"""
+Memory accounting and state consistency checks for IRC sessions.
+
+report()            Object counts and approximate sizes of the session state.
+check()             Finds stale state, like users we do not share a channel with anymore.
+module_memory()     Memory allocated per module, from a tracemalloc snapshot.
+                    Tracing must be started first, see start_tracing().
+
+The checks run periodically (every `state_check_interval` seconds, 3600 by default)
+and problems are logged as warnings. The !memory command shows them on IRC.
+"""
+
+import collections
+import os
+import sys
+import tracemalloc
+
+from utils.logger import logging
+
+
+def sizeof(obj):
+    """
+    Approximate size of an object, its attribute dict and the strings in it.
+    References to other objects are not followed.
+    """
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        size += sum(sys.getsizeof(value) for value in attributes.values() if isinstance(value, str))
+    return size
+
+
+class Diagnostics:
+    def __init__(self, session):
+        self.session = session
+        self.job = None
+
+    def schedule(self, interval):
+        if self.job:
+            self.job.cancel()
+        self.job = self.session.scheduler.call_every(interval, self.periodic_check)
+
+    def report(self):
+        session = self.session
+        memberships = sum(len(c.users) for c in session.channels)
+        usermodes = sum(len(c.usermodes) for c in session.channels)
+        size = sum(sizeof(u) for u in session.users) + sys.getsizeof(session.users)
+        size += sum(sizeof(c) + sys.getsizeof(c.users) + sys.getsizeof(c.usermodes) for c in session.channels)
+        return {
+            'users': len(session.users),
+            'channels': len(session.channels),
+            'memberships': memberships,
+            'usermodes': usermodes,
+            'events': len(session.events),
+            'inbound': len(session.protocol.inbound),
+            'recv_buffer': len(session.recv_buffer),
+            'jobs': len(session.scheduler.heap),
+            'bytes': size,
+        }
+
+    def check(self):
+        """
+        Returns a list of (problem, object) tuples.
+        """
+        session = self.session
+        problems = []
+        members = set()
+        tracked = set(session.users)  # Set lookups, the lists can hold thousands of users.
+        for channel in session.channels:
+            users = set(channel.users)
+            members.update(users)
+            for user in [u for u in channel.users if u not in tracked]:
+                problems.append((f'{user} is in {channel} but not tracked by the session', user))
+            for user in [u for u in channel.usermodes if u not in users]:
+                problems.append((f'{user} has usermodes on {channel} but is not in it', user))
+
+        for user in [u for u in session.users if u not in members and u.nickname != session.nickname]:
+            problems.append((f'{user} is still tracked, but shares no channels with us', user))
+
+        for nickname, count in collections.Counter(u.nickname for u in session.users).items():
+            if count > 1:
+                problems.append((f'{count} user objects for {nickname}', nickname))
+        return problems
+
+    def prune(self):
+        """
+        Forget users we do not share any channels with. Returns the number of removed users.
+        """
+        members = {u for c in self.session.channels for u in c.users}
+        stale = [u for u in self.session.users if u not in members and u.nickname != self.session.nickname]
+        for user in stale:
+            user.quit()
+        return len(stale)
+
+    def periodic_check(self):
+        report = self.report()
+        self.session.log.info(f'State of {self.session}: ' + ', '.join(f'{k}={v}' for k, v in report.items()))
+        problems = self.check()
+        for problem, _ in problems[:20]:
+            self.session.log.warning(f'State check: {problem}')
+        if len(problems) > 20:
+            self.session.log.warning(f'State check: {len(problems) - 20} more problems.')
+
+    @staticmethod
+    def start_tracing(frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            logging.info('Started tracemalloc.')
+
+    @staticmethod
+    def stop_tracing():
+        tracemalloc.stop()
+
+    def module_memory(self):
+        """
+        Returns (module name, bytes, allocations) for every loaded module, based on where
+        the memory still in use was allocated. Requires tracemalloc to be tracing.
+        """
+        if not tracemalloc.is_tracing():
+            return []
+        directories = {os.path.dirname(os.path.abspath(m.__file__)): m.__name__.split('.')[-1]
+                       for m in self.session.modules}
+        usage = {name: [0, 0] for name in directories.values()}
+        for stat in tracemalloc.take_snapshot().statistics('filename'):
+            name = directories.get(os.path.dirname(os.path.abspath(stat.traceback[0].filename)))
+            if name:
+                usage[name][0] += stat.size
+                usage[name][1] += stat.count
+        return sorted(((name, size, count) for name, (size, count) in usage.items()), key=lambda x: -x[1])
+
+    def __repr__(self):
+        return f'<Diagnostics for {self.session}>'
@@ -0,0 +1,158 @@
+"""
+Hostmask matching for ignore lists, auto-op lists, ban lists and the like.
+
+A MaskSet holds any number of nick!user@host glob masks (* and ? wildcards) and finds the ones
+matching a hostmask without testing every mask:
+
+- masks without wildcards are looked up in a dictionary;
+- other masks are indexed by their literal prefix or suffix (whichever is longer), for example
+  *!*@*.example.com is indexed by ".example.com". Only masks sharing a prefix or suffix with the
+  hostmask are tested;
+- masks without any literal prefix or suffix (*!*@* or *foo*) are combined into a single regex.
+
+Matching is case insensitive according to the server's CASEMAPPING.
+Create one from a module with:
+
+masks = self.session.protocol.new_maskset(['*!*@*.example.com', 'baduser!*@*'])
+if masks.match(self.session.event_user_obj.hostmask):
+    ...
+"""
+
+import re
+
+CASEMAPPINGS = {
+    'ascii': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'),
+    'rfc1459': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^'),
+    'strict-rfc1459': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\', 'abcdefghijklmnopqrstuvwxyz{}|'),
+}
+
+
+def irc_lower(text, casemapping='rfc1459'):
+    return text.translate(CASEMAPPINGS.get(casemapping, CASEMAPPINGS['rfc1459']))
+
+
+def mask_to_regex(mask):
+    """
+    Translate a glob mask into a regex. Unlike fnmatch, [ and ] are literal characters.
+    """
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in mask)
+
+
+class MaskSet:
+    def __init__(self, masks=(), casemapping='rfc1459'):
+        self.casemapping = casemapping
+        self.masks = {}  # Normalised mask: original mask.
+        self.exact = {}
+        self.prefixes = {}  # Literal prefix: {mask: compiled regex}
+        self.suffixes = {}
+        self.prefix_lengths = set()
+        self.suffix_lengths = set()
+        self.fallback = {}
+        self.combined = None
+        for mask in masks:
+            self.add(mask)
+
+    def normalise(self, text):
+        return irc_lower(text, self.casemapping)
+
+    def add(self, mask):
+        key = self.normalise(mask)
+        if key in self.masks:
+            return
+        self.masks[key] = mask
+        self._index(key)
+
+    def remove(self, mask):
+        key = self.normalise(mask)
+        if self.masks.pop(key, None) is None:
+            return
+        self.exact.pop(key, None)
+        for index, lengths in ((self.prefixes, self.prefix_lengths), (self.suffixes, self.suffix_lengths)):
+            for literal in [literal for literal, masks in index.items() if key in masks]:
+                del index[literal][key]
+                if not index[literal]:
+                    del index[literal]
+            lengths.clear()
+            lengths.update(len(literal) for literal in index)
+        if self.fallback.pop(key, None):
+            self.combined = None
+
+    def set_casemapping(self, casemapping):
+        """
+        Re-index all masks with another casemapping, for example after receiving ISUPPORT.
+        """
+        if casemapping == self.casemapping:
+            return
+        masks = list(self.masks.values())
+        self.__init__(masks, casemapping)
+
+    def _index(self, key):
+        wildcards = [i for i, c in enumerate(key) if c in '*?']
+        if not wildcards:
+            self.exact[key] = key
+            return
+        prefix, suffix = key[:wildcards[0]], key[wildcards[-1] + 1:]
+        regex = re.compile(mask_to_regex(key), re.DOTALL)
+        if not prefix and not suffix:
+            self.fallback[key] = regex
+            self.combined = None
+        elif len(prefix) >= len(suffix):
+            self.prefixes.setdefault(prefix, {})[key] = regex
+            self.prefix_lengths.add(len(prefix))
+        else:
+            self.suffixes.setdefault(suffix, {})[key] = regex
+            self.suffix_lengths.add(len(suffix))
+
+    def _candidates(self, hostmask):
+        if hostmask in self.exact:
+            yield hostmask, None
+        for length in self.prefix_lengths:
+            for item in self.prefixes.get(hostmask[:length], {}).items():
+                yield item
+        for length in self.suffix_lengths:
+            if length <= len(hostmask):
+                for item in self.suffixes.get(hostmask[len(hostmask) - length:], {}).items():
+                    yield item
+
+    def _combined(self):
+        if self.combined is None:
+            self.keys = list(self.fallback)
+            self.combined = re.compile('|'.join(f'(?P<m{i}>{mask_to_regex(key)})' for i, key in enumerate(self.keys)),
+                                       re.DOTALL)
+        return self.combined
+
+    def match(self, hostmask):
+        """
+        Returns the first mask matching `hostmask` (nick!user@host), or None.
+        """
+        hostmask = self.normalise(hostmask)
+        for key, regex in self._candidates(hostmask):
+            if regex is None or regex.fullmatch(hostmask):
+                return self.masks[key]
+        if self.fallback:
+            found = self._combined().fullmatch(hostmask)
+            if found:
+                return self.masks[self.keys[int(found.lastgroup[1:])]]
+        return None
+
+    def matches(self, hostmask):
+        """
+        Returns all masks matching `hostmask`.
+        """
+        hostmask = self.normalise(hostmask)
+        found = [self.masks[key] for key, regex in self._candidates(hostmask)
+                 if regex is None or regex.fullmatch(hostmask)]
+        found.extend(self.masks[key] for key, regex in self.fallback.items() if regex.fullmatch(hostmask))
+        return found
+
+    def __contains__(self, mask):
+        return self.normalise(mask) in self.masks
+
+    def __iter__(self):
+        return iter(list(self.masks.values()))
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __repr__(self):
+        return f'<MaskSet {len(self.masks)} masks ({self.casemapping})>'
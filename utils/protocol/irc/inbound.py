@@ -0,0 +1,91 @@
+"""
+Bounded inbound line queue with flood shedding.
+
+All received lines pass through this queue before they are parsed. While the queue is longer
+than `shed_above` lines, we are falling behind and low priority lines are shed before they
+reach the parser, state updates and modules:
+
+drop        Drop all low priority lines.
+sample      Keep one in `sample_rate` low priority lines.
+
+Low priority lines are PRIVMSG and NOTICE lines that are not commands (do not start with the
+command prefix). Everything else, like PING, NICK, QUIT, KICK and numerics, is never shed.
+Low priority lines are also shed when the queue holds `maxlen` lines.
+
+Lines are handled for at most `time_budget` seconds per iteration of the event loop, the rest stay
+queued while the loop keeps reading from the socket. So the queue only grows when lines arrive faster
+than we can handle them.
+"""
+
+import collections
+
+from utils.logger import logging
+
+LOW_PRIORITY = {'PRIVMSG', 'NOTICE'}
+
+
+class InboundQueue:
+    policies = ['drop', 'sample']
+
+    def __init__(self, maxlen=5000, shed_above=500, policy='drop', sample_rate=10, cmdprefix='!', time_budget=0.05,
+                 log=logging):
+        self.lines = collections.deque()
+        self.log = log  # The logger of the session, the root logger if there is none.
+        self.time_budget = time_budget
+        self.maxlen = maxlen
+        self.shed_above = shed_above
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.cmdprefix = cmdprefix
+        self.shedding = 0
+        self.sampled = 0
+        self.accepted = 0
+        self.shed = collections.Counter()  # Shed lines per command.
+        self.high_water = 0
+
+    def low_priority(self, line):
+        """
+        Cheap classification, without fully parsing the line.
+        Returns the command of a low priority line, None otherwise.
+        """
+        parts = line.split(' ', 3) if line.startswith(':') else [''] + line.split(' ', 2)
+        if len(parts) < 4 or parts[1].upper() not in LOW_PRIORITY:
+            return None
+        text = parts[3][1:] if parts[3].startswith(':') else parts[3]
+        return None if text.startswith(self.cmdprefix) else parts[1].upper()
+
+    def put(self, line):
+        size = len(self.lines)
+        command = self.low_priority(line) if size >= self.shed_above or size >= self.maxlen else None
+        if command:
+            if not self.shedding:
+                self.shedding = 1
+                self.log.warning(f'Inbound queue holds {size} lines, shedding low priority lines ({self.policy}).')
+            self.sampled += 1
+            if self.policy == 'drop' or size >= self.maxlen or self.sampled % self.sample_rate:
+                self.shed[command] += 1
+                return False
+
+        self.lines.append(line)
+        self.accepted += 1
+        if len(self.lines) > self.high_water:
+            self.high_water = len(self.lines)
+        return True
+
+    def get(self):
+        line = self.lines.popleft()
+        if self.shedding and not self.lines:
+            self.shedding = 0
+            self.log.warning(f'Inbound queue drained. {self.stats()}')
+        return line
+
+    def stats(self):
+        shed = ', '.join(f'{command}: {count}' for command, count in self.shed.items()) or 'none'
+        return f'Accepted {self.accepted} lines, shed {sum(self.shed.values())} ({shed}), ' \
+               f'highest queue length {self.high_water}.'
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __repr__(self):
+        return f'<InboundQueue {len(self.lines)}/{self.maxlen}>'
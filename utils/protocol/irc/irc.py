@@ -5,12 +5,23 @@ import re
 import socket
 import ssl
 import random
+import time
+import weakref
 from pathlib import Path
 
 from utils.protocol.irc import classes
+from utils.protocol.irc.diagnostics import Diagnostics
+from utils.protocol.irc.hostmask import MaskSet, irc_lower
+from utils.protocol.irc.inbound import InboundQueue
+from utils.protocol.irc.lag import LagMonitor
+from utils.protocol.irc.queries import QueryManager
+from utils.protocol.irc.triggers import TriggerSet
+from utils.ratelimit import RateLimiter
 from utils.settings import irc
 from utils.logger import logging
 
+MAX_LINE_BYTES = 512  # Including the trailing \r\n.
+
 
 class RPL(enum.Enum):
     """
@@ -20,9 +31,11 @@ class RPL(enum.Enum):
     ISUPPORT = 5
 
     NAMEREPLY = 353
+    ENDOFMOTD = 376
 
 
 class ERR(enum.Enum):
+    NOMOTD = 422
     NICKNAMEINUSE = 433
 
 
@@ -44,6 +57,9 @@ class IRCEvent(enum.Enum):
 
 class IRC:
     cert = None
+    module_index = None  # Module file name: module dir name. Shared by all sessions.
+    module_cache = {}  # Module file name: (module object, module dir name).
+    shared_instances = {}  # Module object: the instance serving all sessions, for shared modules.
     ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS)
     IRCEvent = IRCEvent
 
@@ -58,14 +74,25 @@ class IRC:
         self.session.channels = []
 
         self.session.modules = {}
-        logging.info(f'Socket for this session: {self.session.sock}')
+        self.session.log.info(f'Socket for this session: {self.session.sock}')
 
         self.session.protocol = self
-        logging.debug(f'Protocol for this session set: {self.session.protocol}')
+        self.session.log.debug(f'Protocol for this session set: {self.session.protocol}')
 
         self.mod_dir = Path(os.path.dirname(os.path.abspath(__file__)) + '/modules/')
-        logging.debug(f"Module dir for this protocol set: {self.mod_dir}")
+        self.session.log.debug(f"Module dir for this protocol set: {self.mod_dir}")
         self.cmdprefix = "!"
+        self.cmdprefixes = self.cmdprefix  # Including those of logical sessions, see utils/multiplex.py.
+        self.inbound = InboundQueue(cmdprefix=self.cmdprefixes, log=self.session.log)
+        self.command_limiter = RateLimiter()
+        self.masksets = weakref.WeakSet()  # All MaskSets of this session, see new_maskset().
+        self.ignores = self.new_maskset()
+        self.diagnostics = Diagnostics(self.session)
+        self.lag = LagMonitor(self.session)
+        self.triggers = TriggerSet(log=self.session.log)
+        self.queries = QueryManager(self.session)
+        self.autojoin_job = None
+        self.process_job = None  # Scheduled while lines are waiting in the inbound queue.
         self.load_all_modules()
 
     def list_mods(self):
@@ -75,100 +102,188 @@ class IRC:
             mods.append(file)
         return mods
 
-    def load_module(self, name, reload=False):
+    def module_files(self, rescan=False):
+        """
+        Returns {file name: module dir name} for all modules in the module dir.
+        The directories are only scanned once for all sessions, unless `rescan` is true.
+        """
+        if rescan or IRC.module_index is None:
+            index = {}
+            for d in os.listdir(self.mod_dir):
+                mod_dir = str(Path(str(self.mod_dir) + '/' + d))
+                if not os.path.isdir(mod_dir) or d.startswith("__"):
+                    continue
+                for file in [file for file in os.listdir(mod_dir) if not file.startswith('__') and file.endswith('.py')]:
+                    index[file] = d
+            IRC.module_index = index
+        return IRC.module_index
+
+    def import_module(self, name, reload=False):
+        """
+        Imports a module file once for all sessions, and returns (module object, module dir name).
+        """
+        if reload or name not in IRC.module_cache:
+            base_dir_name = self.module_files().get(name) or self.module_files(rescan=True).get(name)
+            if not base_dir_name:
+                logging.warning(f"Module {name} not found in {self.mod_dir}")
+                return None, None
+            logging.debug(f"Looking for callables in {name}...")
+            file = name.split('.py')[:1][0]
+            relpath = os.path.relpath(os.path.dirname(__file__)).replace('\\', '.').replace('/', '.')
+            package_path = relpath + '.modules.' + base_dir_name + '.' + file
+            logging.debug(f"Importing package: {package_path}")
+            module = importlib.import_module(package_path)  # If already exists, reload.
+            if reload:
+                logging.debug(f"Calling importlib.reload()")
+                module = importlib.reload(module)
+            logging.debug(f"Imported: {module}")
+
+            mod_data_dir = Path(str(self.mod_dir) + f'/{base_dir_name}/data/')
+            if not os.path.exists(mod_data_dir):
+                logging.info(f"Creating: {mod_data_dir}")
+                os.makedirs(mod_data_dir)
+            IRC.module_cache[name] = (module, base_dir_name)
+        return IRC.module_cache[name]
+
+    def load_module(self, name, reload=False, session=None):
         """
         :param name:    name of the module, i.e: tensorflow_ai
         :param reload:  boolean indicating if a reload is in order
+        :param session: session to load the module for, a logical session on this connection.
+                        Defaults to our own session.
         :return:        None
+
+        Module code is imported once and shared by all sessions.
+        If the IRCModule class has `shared = True`, a single instance serves all sessions as well.
         """
-        for d in os.listdir(self.mod_dir):
-            mod_dir = str(Path(str(self.mod_dir) + '/' + d))
-            if not os.path.isdir(mod_dir) or mod_dir.startswith("__"):
-                continue
-            for file in [file for file in os.listdir(mod_dir) if not file.startswith('__') \
-                                                                 and file.endswith('.py') and file == name]:
-                base_dir_name = os.path.basename(mod_dir)
-                logging.debug(f"Looking for callables in {file}...")
-                file = file.split('.py')[:1][0]
-                og_relpath = os.path.relpath(os.path.dirname(__file__)).replace('\\', '/')
-                relpath = os.path.relpath(os.path.dirname(__file__)).replace('\\', '.').replace('/', '.')
-                package_path = relpath + '.modules.' + base_dir_name + '.' + file
-                logging.debug(f"Importing package: {package_path}")
-                module = importlib.import_module(package_path)  # If already exists, reload.
-                if reload:
-                    logging.debug(f"Calling importlib.reload()")
-                    module = importlib.reload(module)
-                logging.debug(f"Imported: {module}")
-
-                itervalues = dict.values
-                for i in itervalues(vars(module)):
-                    if callable(i) and i.__name__ == "IRCModule":
-                        self.session.modules[module] = []  # Store callables here.
-                        mod_data_dir = Path(str(self.mod_dir) + f'/{base_dir_name}/data/')
-                        i.mod_data_dir = str(mod_data_dir)
-                        mod_obj = i(self.session)
-                        self.session.modules[module].append(mod_obj)
-                        logging.info(f'Module {mod_obj} loaded.')
-                        logging.info(f'Callable: {i}')
-                        if not os.path.exists(mod_data_dir):
-                            logging.info(f"Creating: {mod_data_dir}")
-                            os.makedirs(mod_data_dir)
-
-    def unload_module(self, module):
+        session = session or self.session
+        module, base_dir_name = self.import_module(name, reload=reload)
+        if not module:
+            return
+
+        itervalues = dict.values
+        for i in itervalues(vars(module)):
+            if callable(i) and i.__name__ == "IRCModule":
+                session.modules[module] = []  # Store callables here.
+                i.mod_data_dir = str(Path(str(self.mod_dir) + f'/{base_dir_name}/data/'))
+                if getattr(i, 'shared', False):
+                    mod_obj = IRC.shared_instances.get(module)
+                    if not mod_obj or reload:
+                        mod_obj = IRC.shared_instances[module] = i(None)
+                        mod_obj.sessions = []
+                    if session not in mod_obj.sessions:
+                        mod_obj.sessions.append(session)
+                else:
+                    mod_obj = i(session)
+                session.modules[module].append(mod_obj)
+                self.session.log.info(f'Module {mod_obj} loaded.')
+                self.session.log.info(f'Callable: {i}')
+
+    def unload_module(self, module, session=None):
         """
         Callable objects are stored in the session.modules dictionary:
         session.modules[module] where `module` is a module object.
+        Shared instances are only stopped when no session uses them anymore.
         """
-        for callable in [callable for callable in self.session.modules[module] if hasattr(callable, 'stop')]:
-            callable.active = 0  # You can never be too sure.
-            callable.stop()
-        del self.session.modules[module]
-
-    def reload_module(self, module):
+        session = session or self.session
+        for callable in session.modules[module]:
+            if getattr(callable, 'shared', False):
+                if session in callable.sessions:
+                    callable.sessions.remove(session)
+                session.offloader.cancel(callable)  # Only the tasks it started for this session.
+                session.protocol.triggers.unregister_owner(callable)  # And the triggers on its connection.
+                if callable.sessions:
+                    continue
+                if IRC.shared_instances.get(module) is callable:
+                    del IRC.shared_instances[module]
+            if hasattr(callable, 'stop'):
+                callable.active = 0  # You can never be too sure.
+                callable.stop()
+            session.offloader.cancel(callable)
+            session.protocol.triggers.unregister_owner(callable)
+        del session.modules[module]
+
+    def reload_module(self, module, session=None):
         """
         Reload <module>. It should be a module object.
+        A shared instance is replaced for all sessions using it at once, so they keep sharing a single
+        instance, and the old one is stopped once.
         """
+        session = session or self.session
         name = os.path.basename(module.__file__)
         name = os.path.relpath(name)
-        self.unload_module(module)
-        self.load_module(name, reload=True)
+        shared = next((c for c in session.modules.get(module, ()) if getattr(c, 'shared', False)), None)
+        sessions = list(shared.sessions) if shared else [session]
+        for s in sessions:
+            s.protocol.unload_module(module, s)
+        self.import_module(name, reload=True)
+        for s in sessions:
+            s.protocol.load_module(name, session=s)
 
     def load_all_modules(self):
-        # logging.debug(f"Looking for directories in {os.listdir(self.mod_dir)}")
-        for d in os.listdir(self.mod_dir):
-            mod_dir = str(Path(str(self.mod_dir) + '/' + d))
-            if not os.path.isdir(mod_dir) or mod_dir.startswith("__"):
-                continue
-            for file in [file for file in os.listdir(mod_dir) if not file.startswith('__') and file.endswith('.py')]:
-                self.load_module(file)
+        for file in self.module_files():
+            self.load_module(file)
 
     def run(self):
         """
         Check IRC attributes and attempt to connect to the server.
         """
         irc.check_settings(self.session)
+        self.inbound.maxlen = getattr(self.session, 'inbound_limit', self.inbound.maxlen)
+        self.inbound.shed_above = getattr(self.session, 'shed_above', self.inbound.shed_above)
+        self.inbound.policy = getattr(self.session, 'shed_policy', self.inbound.policy)
+        self.inbound.sample_rate = getattr(self.session, 'shed_sample_rate', self.inbound.sample_rate)
+        self.command_limiter.rate = getattr(self.session, 'command_rate', self.command_limiter.rate)
+        self.command_limiter.burst = getattr(self.session, 'command_burst', self.command_limiter.burst)
+        for mask in getattr(self.session, 'ignore', []):
+            self.ignores.add(mask)
+        self.diagnostics.schedule(getattr(self.session, 'state_check_interval', 3600))
+        self.lag.ping_interval = getattr(self.session, 'ping_interval', self.lag.ping_interval)
+        self.lag.stall_timeout = getattr(self.session, 'stall_timeout', self.lag.stall_timeout)
+        self.queries.ttl = getattr(self.session, 'query_ttl', self.queries.ttl)
         server = f'{self.session.server}:{self.session.port}'
-        logging.debug(f'Connecting to {server} on IRC...')
+        self.session.log.debug(f'Connecting to {server} on IRC...')
         if self.session.tls:
             if hasattr(self.session, 'cert'):
                 self.ssl_ctx.load_cert_chain(self.session.cert, self.session.cert)
-            logging.info('Wrapping socket in TLS.')
+            self.session.log.info('Wrapping socket in TLS.')
             self.session.sock = self.ssl_ctx.wrap_socket(self.session.sock)
             try:
                 self.session.sock = self.ssl_ctx.wrap_socket(self.session.sock)
             except ssl.SSLError as ex:
-                logging.info(f'Error: {ex}')
-                logging.info('Check your port and make sure the server accepts TLS connections:')
-                logging.info(f'Attempted to connect to {server} over TLS.')
+                self.session.log.info(f'Error: {ex}')
+                self.session.log.info('Check your port and make sure the server accepts TLS connections:')
+                self.session.log.info(f'Attempted to connect to {server} over TLS.')
                 self.session.quit()
                 return
             except OSError as ex:
-                logging.exception(ex)
-                logging.info(f'Failed to connect to {server}: TLS flag: {self.session.tls}')
+                self.session.log.exception(ex)
+                self.session.log.info(f'Failed to connect to {server}: TLS flag: {self.session.tls}')
         self.session.sock.connect((self.session.server, self.session.port))
-        logging.info(f'Connected: {self.session.sock}')
+        self.session.log.info(f'Connected: {self.session.sock}')
+        self.lag.start()
         self.session.activate_session()
 
+    def reset(self):
+        """
+        Forget all connection state, so we can connect again.
+        """
+        self.session.sock = socket.socket()
+        self.session.connected = 0
+        self.session.users = []
+        self.session.channels = []
+        self.session.events = []
+        self.session.recv_buffer = b''
+        self.support = {}
+        self.inbound.lines.clear()
+        if self.process_job:
+            self.process_job.cancel()
+            self.process_job = None
+        self.lag.stop()
+        if self.autojoin_job:
+            self.autojoin_job.cancel()
+            self.autojoin_job = None
+
     def conn_established(self):
         nickname = ''
         for idx, char in enumerate(self.session.nickname):
@@ -185,10 +300,26 @@ class IRC:
         Triggered on RPL.WELCOME (001)
         """
         self.session.connected = 1
-        logging.info('Successfully connected to IRC.')
-        # Read session.config to perform on-connect shit. For now let's hardcode shit.
-        if hasattr(self.session, 'channel'):
-            self.join(self.session.channel)
+        self.session.log.info('Successfully connected to IRC.')
+        # Join once the server told us its limits (ISUPPORT), which it has done by the end of the MOTD.
+        # Some servers send no MOTD at all, so don't wait for it forever.
+        self.autojoin_job = self.session.scheduler.call_later(10, self.autojoin)
+
+    def autojoin(self):
+        """
+        Join session.channel and the channels in session.autojoin, with as few lines as possible.
+        Channels with a key are given as "#channel key".
+        """
+        if not self.autojoin_job:
+            return
+        self.autojoin_job.cancel()
+        self.autojoin_job = None
+        channels = ([self.session.channel] if hasattr(self.session, 'channel') else []) + \
+            getattr(self.session, 'autojoin', [])
+        channels = [tuple(c.split(' ', 1)) if ' ' in c else c for c in channels]
+        skipped = self.join_many(channels)
+        if skipped:
+            self.session.log.warning(f'Not joining {len(skipped)} channels, that would exceed CHANLIMIT: {skipped}')
 
     def get_event_objects(self, recv, event=None):
         """
@@ -202,10 +333,14 @@ class IRC:
             user = next((u for u in self.session.users if u.nickname == nick), None)
             if not user:
                 user = classes.User(self.session, nick)
+            user.ident, user.cloakhost = recv[0].split('!', 1)[1].split('@', 1)
 
         if 'CHANTYPES' not in self.session.protocol.support:  # Don't know CHANTYPES yet.
             return user, target
 
+        if event in ('NICK', 'QUIT'):  # No target, recv[2] is the new nickname or the quit message.
+            return user, target
+
         if recv[2][0] in self.session.protocol.support['CHANTYPES']:  # Target is a channel.
             target = next((c for c in self.session.channels if c.name == recv[2]), None)
             if not target:
@@ -217,8 +352,39 @@ class IRC:
 
         return user, target
 
+    def new_maskset(self, masks=()):
+        """
+        Returns a MaskSet for `masks`, using the casemapping of this server.
+        Modules usually create theirs before the server told us its casemapping,
+        so the set is re-indexed when it does.
+        """
+        maskset = MaskSet(masks, self.support.get('CASEMAPPING') or 'rfc1459')
+        self.masksets.add(maskset)
+        return maskset
+
+    def is_ignored(self, user):
+        """
+        Messages from users matching session.ignore are dropped before any handler runs.
+        """
+        return bool(user and self.ignores and self.ignores.match(user.hostmask))
+
+    def command_allowed(self, command):
+        """
+        Rate limit commands per user@host and command, before any handler runs.
+        Users without a known host are limited by nickname.
+        """
+        user = self.session.event_user_obj
+        if not user:
+            return True
+        mask = f'{user.ident}@{user.cloakhost}' if user.cloakhost else user.nickname
+        if self.command_limiter.allow((mask, command.lower())):
+            return True
+        self.session.log.debug(f'Rate limited {command} from {user} ({mask}).')
+        return False
+
     def quit(self, reason=None):
-        self.session.sendline(f'QUIT{" " + reason if reason else ""}')
+        self.session.sendline(f'QUIT{" :" + reason if reason else ""}')
+        self.queries.fail_all('Disconnected')
 
     def get_object(self, value):
         """
@@ -236,113 +402,220 @@ class IRC:
         :param recv: list holding incoming IRC data
         :return: None
         """
-        logging.debug(f'Handling get_events() for session {self.session}')
-        logging.debug(f'Event buffer for {self.session}: {self.session.events}')
+        log = self.session.log
+        log.debug(f'Event buffer for {self.session}: {self.session.events}')
+        self.lag.received()
+        raw = log.raw_mode != 'off'
         for line in recv.split('\n'):
-            if self.session.events:
-                self.session.handle_event(self.session.events)
-                self.session.events = []
-                logging.debug(f'Events for {self.session} flushed.')
-            args = line.split()
-            if not args:
+            if not line:
                 continue
+            if raw:
+                log.raw('>>', line.rstrip('\r'))
+            self.inbound.put(line)
+        if not self.process_job:
+            self.process_inbound()
 
-            if args[0] == 'PING':
-                self.pong(args[1])
-
-            # Check for numeric raws.
-            if len(args) > 1 and args[1].isdigit():
-                self.session.protocol.handle_raw(int(args[1]), args[3:])
-
-            if len(args) <= 2:
-                continue
-
-            # These events most likely require objects.
-            # Let's fetch the target of the event.
-            event = args[1].upper()
-            self.session.event_user_obj, self.session.event_target_obj = \
-                self.get_event_objects(args, event)
-
-            if not self.session.event_target_obj:  ### NICK AND QUIT DO NOT RETURN ANYTHING HERE
-                if event == 'ERROR':
-                    self.session.events.append((IRCEvent.ERROR, args[2:]))
-                    # User might not have an object yet.
-                    if self.session.event_user_obj:
-                        self.session.event_user_obj.quit()
-
-                if event == 'QUIT':
-                    self.session.events.append((IRCEvent.QUIT, args[2:]))
+    def process_inbound(self):
+        """
+        Handle queued lines for at most `inbound.time_budget` seconds. Lines that are left wait for the next
+        iteration of the event loop, which keeps reading from the socket in the meantime.
+        So the length of the inbound queue is the real backlog, and shedding starts when we fall behind.
+        """
+        self.process_job = None
+        deadline = time.monotonic() + self.inbound.time_budget
+        while self.inbound:
+            self.handle_line(self.inbound.get())
+            if time.monotonic() > deadline:
+                break
+        if self.inbound:
+            self.process_job = self.session.scheduler.call_soon(self.process_inbound)
+
+    def handle_line(self, line):
+        log = self.session.log
+        if self.session.events:
+            self.session.handle_event(self.session.events)
+            self.session.events = []
+            log.debug(f'Events for {self.session} flushed.')
+        args = line.split()
+        if not args:
+            return
+
+        if args[0] == 'PING':
+            self.pong(args[1])
+
+        if len(args) > 3 and args[1] == 'PONG' and self.lag.pong(args[3].lstrip(':')):
+            return
+
+        # Check for numeric raws.
+        if len(args) > 1 and args[1].isdigit():
+            self.session.protocol.handle_raw(int(args[1]), args[3:])
+
+        if len(args) <= 2:
+            return
+
+        # These events most likely require objects.
+        # Let's fetch the target of the event.
+        event = args[1].upper()
+        self.session.event_user_obj, self.session.event_target_obj = \
+            self.get_event_objects(args, event)
+
+        if not self.session.event_target_obj:  ### NICK AND QUIT DO NOT RETURN ANYTHING HERE
+            if event == 'ERROR':
+                self.session.events.append((IRCEvent.ERROR, args[2:]))
+                # User might not have an object yet.
+                if self.session.event_user_obj:
                     self.session.event_user_obj.quit()
 
-                elif event == 'NICK':
-                    # :user NICK newnick
-                    oldnick = self.session.event_user_obj.nickname
-                    newnick = args[2] if args[2][0] != ':' else args[2][1:]
-                    logging.info(f'[{event}] User {self.session.event_user_obj} changed its nickname to {newnick}')
-                    self.session.event_user_obj.nickname = newnick
-                    self.session.events.append((IRCEvent.NICK, oldnick))
-                continue
+            if event == 'QUIT':
+                self.session.events.append((IRCEvent.QUIT, args[2:]))
+                self.session.event_user_obj.quit()
+                self.queries.forget('WHOIS', self.session.event_user_obj.nickname)
+
+            elif event == 'NICK':
+                # :user NICK newnick
+                oldnick = self.session.event_user_obj.nickname
+                newnick = args[2] if args[2][0] != ':' else args[2][1:]
+                self.session.log.info(f'[{event}] User {self.session.event_user_obj} changed its nickname to {newnick}')
+                self.session.event_user_obj.nickname = newnick
+                self.session.events.append((IRCEvent.NICK, oldnick))
+                self.queries.forget('WHOIS', oldnick)
+            self.publish()
+            self.dispatch(self.session, self.session.events, args)
+            self.fan_out(args)
+            return
+
+        # self.event_target_obj is now either a User or a Channel.
+
+        if type(self.session.event_target_obj).__name__ == 'Channel':
+            self.session.log.info(f'[{event}] Channel on which the event occurs: {self.session.event_target_obj}')
+
+        elif self.session.event_user_obj:
+            # Bot received a private message.
+            pass
+
+        if event == 'JOIN':
+            self.session.events.append((IRCEvent.JOIN, None))
+            self.session.event_target_obj.add_user(self.session.event_user_obj)
+
+        elif event == 'PART':
+            self.session.events.append((IRCEvent.PART, None))
+            self.session.event_target_obj.remove_user(self.session.event_user_obj)
+
+        if len(args) > 3:
+            stripped_data = args[3:]
+            if stripped_data[0].startswith(':'):
+                stripped_data[0] = stripped_data[0][1:]
+
+            if event == 'KICK':
+                kick_target_obj = self.get_object(args[3])
+                reason = args[4:]
+                if reason[0].startswith(':'):
+                    reason[0] = reason[0][1:]
+                self.session.events.append((IRCEvent.KICK, (kick_target_obj, reason)))
+                self.session.event_target_obj.remove_user(kick_target_obj)
+
+            elif event == 'MODE':
+                self.session.events.append((IRCEvent.MODE, stripped_data))
+                self.queries.forget('MODE', args[2])
+
+            elif event == 'PRIVMSG':
+                """
+                Returns a tuple containing the IRCEvent.PRIVMSG object and text,
+                where `text` is a list.
+                """
+                if self.is_ignored(self.session.event_user_obj):
+                    return
+                if stripped_data[0].startswith(self.cmdprefixes) and not self.command_allowed(stripped_data[0]):
+                    return
+                self.session.events.append((IRCEvent.PRIVMSG, stripped_data))
+                if self.triggers:
+                    self.triggers.dispatch(line.split(' :', 1)[1].rstrip('\r') if ' :' in line else '',
+                                           self.session.event_target_obj.name
+                                           if type(self.session.event_target_obj).__name__ == 'Channel' else None)
+
+            elif event == 'NOTICE':
+                """
+                Returns a tuple containing the IRCEvent.PRIVMSG object and text,
+                where `text` is a list.
+                """
+                if self.is_ignored(self.session.event_user_obj):
+                    return
+                self.session.events.append((IRCEvent.NOTICE, stripped_data))
+
+        self.publish()
+        self.dispatch(self.session, self.session.events, args)
+        self.fan_out(args)
+
+    def publish(self):
+        """
+        Publish the events of the current line on the shared event bus.
+        """
+        if not self.session.bus.topics:
+            return
+        channel = self.session.event_target_obj.name \
+            if type(self.session.event_target_obj).__name__ == 'Channel' else None
+        user = str(self.session.event_user_obj) if self.session.event_user_obj else None
+        for event, data in self.session.events:
+            self.session.bus.publish(self.session, channel, event, user, data)
+
+    def fan_out(self, args):
+        """
+        Events are parsed once, and passed on to the logical sessions on this connection.
+        """
+        for logical in self.session.logical_sessions:
+            events = self.events_for(logical, self.session.events)
+            if events:
+                logical.handle_event(events)
+                self.dispatch(logical, events, args)
 
-            # self.event_target_obj is now either a User or a Channel.
-
-            if type(self.session.event_target_obj).__name__ == 'Channel':
-                logging.info(f'[{event}] Channel on which the event occurs: {self.session.event_target_obj}')
-
-            elif self.session.event_user_obj:
-                # Bot received a private message.
-                pass
-
-            if event == 'JOIN':
-                self.session.events.append((IRCEvent.JOIN, None))
-                self.session.event_target_obj.add_user(self.session.event_user_obj)
-
-            elif event == 'PART':
-                self.session.events.append((IRCEvent.PART, None))
-                self.session.event_target_obj.remove_user(self.session.event_user_obj)
-
-            if len(args) > 3:
-                stripped_data = args[3:]
-                if stripped_data[0].startswith(':'):
-                    stripped_data[0] = stripped_data[0][1:]
-
-                if event == 'KICK':
-                    kick_target_obj = self.get_object(args[3])
-                    reason = args[4:]
-                    if reason[0].startswith(':'):
-                        reason[0] = reason[0][1:]
-                    self.session.events.append((IRCEvent.KICK, (kick_target_obj, reason)))
-                    self.session.event_target_obj.remove_user(kick_target_obj)
-
-                elif event == 'MODE':
-                    self.session.events.append((IRCEvent.MODE, stripped_data))
-
-                elif event == 'PRIVMSG':
-                    """
-                    Returns a tuple containing the IRCEvent.PRIVMSG object and text,
-                    where `text` is a list.
-                    """
-                    self.session.events.append((IRCEvent.PRIVMSG, stripped_data))
-
-                elif event == 'NOTICE':
-                    """
-                    Returns a tuple containing the IRCEvent.PRIVMSG object and text,
-                    where `text` is a list.
-                    """
-                    self.session.events.append((IRCEvent.NOTICE, stripped_data))
-
-            for m in self.session.modules:
-                for callable in self.session.modules[m]:
-                    for event in self.session.events:
-                        logging.info(f'Calling {callable} with event: {event}')
-                        callable.run(event, args)
+    def dispatch(self, session, events, args):
+        """
+        Call the modules of `session` with `events`.
+        """
+        for m in session.modules:
+            for callable in session.modules[m]:
+                for event in events:
+                    self.session.log.debug(f'Calling {callable} with event: {event}')
+                    # Shared module instances serve many sessions, so they are told which one.
+                    extra = (session,) if getattr(callable, 'shared', False) else ()
+                    if self.session.profiler.enabled:
+                        self.session.profiler.run(callable, event, args, *extra)
+                    else:
+                        callable.run(event, args, *extra)
+
+    def events_for(self, logical, events):
+        """
+        Returns the events for a logical session. Its commands are translated to our own command prefix,
+        so its modules do not need to know it. Commands for our own session are left out.
+        """
+        result = []
+        for event, data in events:
+            if event == IRCEvent.PRIVMSG and data:
+                if data[0].startswith(logical.cmdprefix):
+                    data = [self.cmdprefix + data[0][len(logical.cmdprefix):]] + data[1:]
+                elif data[0].startswith(self.cmdprefixes):
+                    continue
+            result.append((event, data))
+        return result
+
+    def update_cmdprefixes(self):
+        """
+        Commands of logical sessions are rate limited and never shed as well.
+        """
+        prefixes = [self.cmdprefix] + [s.cmdprefix for s in self.session.logical_sessions]
+        self.cmdprefixes = tuple(prefixes) if len(prefixes) > 1 else self.cmdprefix
+        self.inbound.cmdprefix = self.cmdprefixes
 
     def handle_raw(self, num, data):
+        if num in self.queries.numerics:
+            self.queries.handle(num, data)
+
         if num == ERR.NICKNAMEINUSE.value:
             if hasattr(self.session, 'alt_nick'):
                 newnick = self.session.alt_nick
             else:
                 newnick = self.session.nickname + '-' + ''.join(random.choice('1234567890') for _ in range(3))
-            logging.info(f'[{ERR(num).name}] Nickname {self.session.nickname} is already in use. Trying {newnick}...')
+            self.session.log.info(f'[{ERR(num).name}] Nickname {self.session.nickname} is already in use. Trying {newnick}...')
             self.nick(newnick)
 
         if num == RPL.WELCOME.value:
@@ -350,6 +623,9 @@ class IRC:
             classes.User(self.session, self.session.nickname)
             self.connect_success()
 
+        elif num in (RPL.ENDOFMOTD.value, ERR.NOMOTD.value):
+            self.autojoin()
+
         elif num == RPL.ISUPPORT.value:
             for entry in data:
                 if entry.startswith(':'):
@@ -359,6 +635,9 @@ class IRC:
                     support = entry.split('=')[0]
                     value = entry.split('=')[1]
                 self.support[support] = value
+            if 'CASEMAPPING' in self.support:
+                for maskset in list(self.masksets):
+                    maskset.set_casemapping(self.support['CASEMAPPING'])
 
         elif num == RPL.NAMEREPLY.value:
             channel = data[1]
@@ -393,16 +672,205 @@ class IRC:
         self.session.sendline('PONG ' + arg)
 
     def say(self, msg, target):
+        self.send_text('PRIVMSG', msg, target)
+
+    def notice(self, msg, target):
+        self.send_text('NOTICE', msg, target)
+
+    def send_text(self, command, msg, target):
+        """
+        Send `msg` with PRIVMSG or NOTICE. Long messages are split at UTF-8 character boundaries
+        so that no line exceeds the 512 byte limit, as it will be seen by the receiving clients.
+        `target` can also be a list of targets, which are packed into as few lines as TARGMAX allows.
+        """
         if not target:
-            target = str(self.session.event_target_obj)
-        self.session.sendline(f'PRIVMSG {target} :{msg}')
+            target = self.session.event_target_obj
+        targets = [str(t) for t in target] if isinstance(target, (list, tuple, set)) else [str(target)]
+        msg = str(msg)
+        for group in self.group_targets(command, targets, msg):
+            group = ','.join(group)
+            for chunk in self.split_text(msg, self.text_budget(command, group)):
+                self.session.sendline(f'{command} {group} :{chunk}')
+
+    def prefix_length(self):
+        """
+        Length in bytes of the ":nick!ident@host " prefix the server adds to our messages.
+        If our ident or host is not known yet, the maximum length is assumed.
+        """
+        me = next((u for u in self.session.users if u.nickname == self.session.nickname), None)
+        ident_len = len(me.ident.encode()) if me and me.ident else int(self.support.get('USERLEN') or 10) + 1  # ~
+        host_len = len(me.cloakhost.encode()) if me and me.cloakhost else int(self.support.get('HOSTLEN') or 63)
+        return len(self.session.nickname.encode()) + ident_len + host_len + 4  # ":", "!", "@" and " "
+
+    def text_budget(self, command, target):
+        return MAX_LINE_BYTES - 2 - self.prefix_length() - len(f'{command} {target} :'.encode())
+
+    def target_limit(self, command, default=1):
+        """
+        Maximum number of targets for `command`, based on ISUPPORT TARGMAX or MAXTARGETS.
+        Returns None if there is no limit, and `default` if the server did not tell.
+        """
+        for entry in (self.support.get('TARGMAX') or '').split(','):
+            name, _, limit = entry.partition(':')
+            if name.upper() == command:
+                return int(limit) if limit else None
+        if self.support.get('MAXTARGETS') and command in ('PRIVMSG', 'NOTICE'):
+            return int(self.support['MAXTARGETS'])
+        return default
+
+    def group_targets(self, command, targets, msg):
+        """
+        Pack targets into groups, as long as adding a target does not cost an additional line.
+        """
+        limit = self.target_limit(command)
+        group, lines = [], 0
+        for target in targets:
+            if group and (limit is None or len(group) < limit):
+                new_lines = len(self.split_text(msg, self.text_budget(command, ','.join(group + [target]))))
+                if new_lines <= lines:
+                    group.append(target)
+                    continue
+            if group:
+                yield group
+            group = [target]
+            lines = len(self.split_text(msg, self.text_budget(command, target)))
+        if group:
+            yield group
+
+    @staticmethod
+    def split_text(text, budget):
+        """
+        Split text in chunks of at most `budget` bytes when UTF-8 encoded.
+        Splits on newlines, and on the last space of a chunk if there is one in its second half.
+        Never cuts a multi-byte character in half. Every line gives at least one chunk, even a blank one.
+        """
+        budget = max(budget, 4)  # Room for at least one character.
+        chunks = []
+        for line in text.replace('\r', '').split('\n'):
+            data = line.encode('utf-8')
+            first = len(chunks)
+            while len(data) > budget:
+                cut = budget
+                while data[cut] & 0xC0 == 0x80:  # Continuation byte, move back to the start of the character.
+                    cut -= 1
+                space = data.rfind(b' ', 0, cut + 1)
+                if space > budget // 2:
+                    chunks.append(data[:space].decode('utf-8'))
+                    data = data[space + 1:]
+                else:
+                    chunks.append(data[:cut].decode('utf-8'))
+                    data = data[cut:]
+            if data or len(chunks) == first:
+                chunks.append(data.decode('utf-8'))
+        return chunks
+
+    @staticmethod
+    def pack(items, limit, cost, budget):
+        """
+        Split `items` into groups of at most `limit` items (None for no limit),
+        where the costs of the items in a group add up to at most `budget` bytes.
+        """
+        group, size = [], 0
+        for item in items:
+            if group and ((limit and len(group) >= limit) or size + cost(item) > budget):
+                yield group
+                group, size = [], 0
+            group.append(item)
+            size += cost(item)
+        if group:
+            yield group
+
+    def is_joined(self, channel):
+        casemapping = self.support.get('CASEMAPPING') or 'rfc1459'
+        name = irc_lower(channel, casemapping)
+        return any(irc_lower(c.name, casemapping) == name and any(u.nickname == self.session.nickname for u in c.users)
+                   for c in self.session.channels)
+
+    def chanlimit(self, channels):
+        """
+        Returns (channels within ISUPPORT CHANLIMIT, channels that would exceed it),
+        counting the channels we are in already.
+        """
+        limits = {}  # Channel prefix: [joined, limit]
+        for entry in (self.support.get('CHANLIMIT') or '').split(','):
+            prefixes, _, limit = entry.partition(':')
+            if limit:
+                counter = [0, int(limit)]  # Prefixes listed together share their limit.
+                for prefix in prefixes:
+                    limits[prefix] = counter
+        for channel in self.session.channels:
+            if channel.name[:1] in limits and self.is_joined(channel.name):
+                limits[channel.name[:1]][0] += 1
+
+        allowed, skipped = [], []
+        for channel in channels:
+            counter = limits.get(channel[0][:1])
+            if counter and counter[0] >= counter[1]:
+                skipped.append(channel[0])
+                continue
+            if counter:
+                counter[0] += 1
+            allowed.append(channel)
+        return allowed, skipped
 
     def join(self, channel):
         self.session.sendline('JOIN ' + channel)
 
+    def join_many(self, channels):
+        """
+        Join many channels with as few lines as possible, within ISUPPORT TARGMAX and CHANLIMIT.
+        `channels` holds channel names, or (channel, key) tuples for channels with a key.
+        Channels we are in already are left out.
+        Returns the channels that were not joined because of CHANLIMIT.
+        """
+        channels = [c if isinstance(c, tuple) else (c, None) for c in channels]
+        channels = [c for c in channels if not self.is_joined(c[0])]
+        channels, skipped = self.chanlimit(channels)
+        # Keys belong to the first channels of a line, so channels with a key go first.
+        channels.sort(key=lambda c: c[1] is None)
+        cost = lambda c: len(c[0].encode()) + 1 + (len(c[1].encode()) + 1 if c[1] else 0)
+        budget = MAX_LINE_BYTES - 2 - len('JOIN')
+        for group in self.pack(channels, self.target_limit('JOIN', None), cost, budget):
+            keys = ','.join(key for _, key in group if key)
+            self.session.sendline(f'JOIN {",".join(name for name, _ in group)}{" " + keys if keys else ""}')
+        return skipped
+
     def part(self, channel):
         self.session.sendline('PART ' + channel)
 
+    def part_many(self, channels, reason=None):
+        """
+        Leave many channels with as few lines as possible, within ISUPPORT TARGMAX.
+        """
+        reason = f' :{reason}' if reason else ''
+        budget = MAX_LINE_BYTES - 2 - len('PART') - len(reason.encode())
+        for group in self.pack(channels, self.target_limit('PART', None), lambda c: len(c.encode()) + 1, budget):
+            self.session.sendline(f'PART {",".join(group)}{reason}')
+
+    def mode_many(self, target, changes):
+        """
+        Send many mode changes with as few lines as possible, within ISUPPORT MODES (3 if the server
+        did not tell). `changes` holds (mode, parameter) tuples, with None for modes without one:
+
+        self.session.protocol.mode_many('#bla', [('+v', nick) for nick in nicks])
+        """
+        if 'MODES' not in self.support:
+            limit = 3
+        else:
+            limit = int(self.support['MODES']) if self.support['MODES'] else None
+        # A mode letter costs at most 2 bytes, if it needs a sign of its own.
+        cost = lambda c: 2 + (len(str(c[1]).encode()) + 1 if c[1] is not None else 0)
+        budget = MAX_LINE_BYTES - 2 - len(f'MODE {target} '.encode())
+        for group in self.pack(changes, limit, cost, budget):
+            modes, sign = '', ''
+            for mode, _ in group:
+                if mode[0] in '+-' and mode[0] != sign:
+                    sign = mode[0]
+                    modes += sign
+                modes += mode.lstrip('+-')
+            params = ' '.join(str(param) for _, param in group if param is not None)
+            self.session.sendline(f'MODE {target} {modes}{" " + params if params else ""}')
+
     def nick(self, newnick):
         self.session.sendline('NICK ' + newnick)
 
@@ -0,0 +1,103 @@
+"""
+Lag measurement and stalled connection detection.
+
+Every `ping_interval` seconds we send PING with a timestamp and measure the round-trip time
+when the server answers with PONG. Modules can use session.protocol.lag to throttle their
+output when the server is slow:
+
+lag.current         Last measured round-trip time in seconds.
+lag.ewma            Exponentially weighted moving average of the round-trip time.
+lag.p99()           99th percentile of the last 100 measurements.
+lag.lag()           Best guess of the current lag: the last measurement, or the age of a PING
+                    that has not been answered yet, whichever is larger.
+
+If nothing at all is received for `stall_timeout` seconds, the connection is considered dead
+and the session reconnects.
+"""
+
+import collections
+import time
+
+TOKEN_PREFIX = 'lag-'
+
+
+class LagMonitor:
+    def __init__(self, session, ping_interval=60, stall_timeout=300, alpha=0.2):
+        self.session = session
+        self.ping_interval = ping_interval
+        self.stall_timeout = stall_timeout
+        self.alpha = alpha
+        self.current = None
+        self.ewma = None
+        self.samples = collections.deque(maxlen=100)
+        self.outstanding = {}  # Token: monotonic time the PING was sent.
+        self.last_recv = time.monotonic()
+        self.jobs = []
+
+    def start(self):
+        """
+        (Re)start measuring, called when connecting.
+        """
+        self.stop()
+        self.last_recv = time.monotonic()
+        self.outstanding = {}
+        scheduler = self.session.scheduler
+        self.jobs = [scheduler.call_every(self.ping_interval, self.ping),
+                     scheduler.call_every(max(1, min(self.ping_interval, self.stall_timeout / 4)), self.check_stall)]
+
+    def stop(self):
+        for job in self.jobs:
+            job.cancel()
+        self.jobs = []
+
+    def received(self):
+        self.last_recv = time.monotonic()
+
+    def ping(self):
+        if not self.session.connected:
+            return
+        sent = time.monotonic()
+        token = f'{TOKEN_PREFIX}{int(sent * 1000000)}'
+        self.outstanding[token] = sent
+        if len(self.outstanding) > 10:  # The server is not answering, forget the oldest.
+            del self.outstanding[next(iter(self.outstanding))]
+        self.session.sendline(f'PING :{token}')
+
+    def pong(self, token):
+        """
+        Handle a PONG reply. Returns False if it was not an answer to one of our PINGs.
+        """
+        sent = self.outstanding.pop(token, None)
+        if sent is None:
+            return False
+        rtt = time.monotonic() - sent
+        self.current = rtt
+        self.ewma = rtt if self.ewma is None else self.alpha * rtt + (1 - self.alpha) * self.ewma
+        self.samples.append(rtt)
+        return True
+
+    def p99(self):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+    def lag(self):
+        waiting = time.monotonic() - min(self.outstanding.values()) if self.outstanding else 0
+        return max(self.current or 0, waiting)
+
+    def check_stall(self):
+        silent = time.monotonic() - self.last_recv
+        if self.session.active and silent > self.stall_timeout:
+            self.session.log.warning(f'Nothing received from the server for {silent:.0f} seconds, reconnecting.')
+            self.stop()
+            self.session.reconnect('Connection stalled')
+
+    def __str__(self):
+        if self.current is None:
+            return 'No lag measured yet.'
+        return f'Lag: {self.current * 1000:.0f}ms, average {self.ewma * 1000:.0f}ms, ' \
+               f'p99 {self.p99() * 1000:.0f}ms over {len(self.samples)} samples.'
+
+    def __repr__(self):
+        return f'<LagMonitor {self.session}>'
@@ -3,21 +3,52 @@ This is a test module for the IRC protocol.
 The main class must be called `IRCModule`, otherwise it won't work.
 You can define as much classes as you wish, and use them in this module.
 
-I wrote a simple timer example that loops every 60 seconds.
+I wrote a simple timer example that runs every 60 seconds.
+Timers are scheduled on the session scheduler, so they do not need a thread of their own:
+
+self.session.scheduler.call_later(delay, callback)          Run once after `delay` seconds.
+self.session.scheduler.call_every(interval, callback)       Run every `interval` seconds.
+self.session.scheduler.call_cron("*/5 * * * *", callback)   Run on a cron-like schedule.
+
+All of them return a job object, call job.cancel() to stop it.
+
+To react to keywords, URLs or other text anywhere in a message, register a trigger instead of
+testing every PRIVMSG in run(), see utils/protocol/irc/triggers.py:
+
+self.session.protocol.triggers.register(self, callback, literal="python", channels=["#bla"])
+
+CPU-heavy work should not be done in run(), because it stalls all sessions.
+The !fib command shows how to run it in the shared process pool instead.
 Like all other modules, it has a reference to your current `session` so you can interact with it.
+
+Module code is imported once, but every session gets its own IRCModule instance.
+Set `shared = True` on the IRCModule class to use a single instance for all sessions instead.
+A shared instance is created with IRCModule(None), and run() receives the session as a third argument:
+
+def run(self, event, recv, session):
 """
 
-import threading
-import time
 from utils.logger import logging
 
 
+def fibonacci(n):
+    """
+    Runs in a worker process, so it must be a top-level function.
+    """
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+
 class IRCModule:
+    offload_limit = 1  # Number of !fib commands that may run at once.
+
     def __init__(self, session):
         self.session = session
         self.active = 1
 
-        SomeTimer(self, self.session).start()
+        self.timer = self.session.scheduler.call_every(60, self.some_timer)
 
     def run(self, event, recv):
         """
@@ -42,6 +73,12 @@ class IRCModule:
             if data[0] == "!sup":
                 self.session.say(f"Sup {self.session.event_user_obj.nickname}!")
 
+            elif data[0] == "!fib" and len(data) > 1 and data[1].isdigit():
+                target = self.session.event_target_obj
+                self.session.offload(self, fibonacci, min(int(data[1]), 100000),
+                                     callback=lambda result: self.session.say(f"Done, that is a {result.bit_length()} bit number.", target),
+                                     errback=lambda ex: self.session.say(f"Failed: {ex}", target), timeout=10)
+
             elif data[0] == "!users":
                 for user in self.session.event_target_obj.users:
                     self.session.say(user)
@@ -66,18 +103,9 @@ class IRCModule:
             self.session.say(f"Why did you kick {kicked_user}?!")
             self.session.say(f"'{reason}' is not a good reason! :(")
 
+    def some_timer(self):
+        print('This will run every 60 seconds, as long as the module is running.')
+
     def stop(self):
         self.active = 0
-
-
-class SomeTimer(threading.Thread):
-    def __init__(self, module, session):
-        self.session = session
-        self.module = module
-        self.kill = threading.Event()
-        threading.Thread.__init__(self)
-
-    def run(self):
-        while self.module.active:
-            print('This will run every 60 seconds, as long as the module is running, or any other condition is true.')
-            time.sleep(60)
+        self.timer.cancel()
@@ -0,0 +1,252 @@
+"""
+Queries to the server, with the replies matched back to the request.
+
+Instead of sending WHOIS and watching the event stream for the numerics, modules ask:
+
+future = self.session.protocol.queries.whois('bob', callback=lambda result: ...)
+
+whois(nick)             Dict with nick, ident, host, realname, server, channels, account, idle,
+                        signon, away, operator and secure.
+who(mask)               List of dicts with channel, nick, ident, host, server, flags and realname.
+list(channels=None)     List of (channel, users, topic) tuples, for the given channels or all of them.
+mode(channel)           Dict with channel, modes, params and created.
+
+All of them return a concurrent.futures.Future. The optional callback receives the result,
+and the errback a QueryError (i.e. no such nick) or TimeoutError. Both run on the session's event loop.
+Do not call future.result() from there, the reply can only arrive after run() returns.
+
+An identical query that is already waiting for its reply is not sent again.
+Every caller gets its own copy of the result, so changing it does not affect the cache or other callers.
+Results are cached for `query_ttl` seconds (60 by default), per nick or channel. A cached WHOIS is
+forgotten when that user changes nick or quits, a cached MODE when the channel modes change.
+"""
+
+import collections
+import concurrent.futures
+import copy
+import time
+
+from utils.protocol.irc.hostmask import irc_lower
+
+WHOIS_REPLIES = {301, 311, 312, 313, 317, 319, 330, 671}
+WHOIS_END = 318
+WHO_REPLY, WHO_END = 352, 315
+LIST_REPLY, LIST_END = 322, 323
+MODE_REPLY, MODE_CREATED = 324, 329
+NOSUCHNICK, NOSUCHSERVER, NOSUCHCHANNEL = 401, 402, 403
+
+
+class QueryError(Exception):
+    pass
+
+
+def trailing(data, idx):
+    """
+    Rejoin the parameters from `idx` on, without the leading ":".
+    """
+    text = ' '.join(data[idx:])
+    return text[1:] if text.startswith(':') else text
+
+
+class Query:
+    def __init__(self, kind, target, key):
+        self.kind = kind
+        self.target = target
+        self.key = key
+        self.future = concurrent.futures.Future()
+        self.result = None
+        self.error = None
+        self.timer = None
+
+    def __repr__(self):
+        return f'<Query {self.kind} {self.target}>'
+
+
+class QueryManager:
+    numerics = WHOIS_REPLIES | {WHOIS_END, WHO_REPLY, WHO_END, LIST_REPLY, LIST_END, MODE_REPLY, MODE_CREATED,
+                                NOSUCHNICK, NOSUCHSERVER, NOSUCHCHANNEL}
+
+    def __init__(self, session, ttl=60, timeout=30, max_entries=1024):
+        self.session = session
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.pending = {}  # key: Query waiting for its reply.
+        self.cache = collections.OrderedDict()  # key: (expiry, result)
+        self.hits = 0
+        self.misses = 0
+
+    def casefold(self, text):
+        return irc_lower(text, self.session.protocol.support.get('CASEMAPPING') or 'rfc1459')
+
+    def whois(self, nick, callback=None, errback=None):
+        return self.query('WHOIS', nick, f'WHOIS {nick}', {'nick': nick, 'channels': []}, callback, errback)
+
+    def who(self, mask, callback=None, errback=None):
+        return self.query('WHO', mask, f'WHO {mask}', [], callback, errback)
+
+    def list(self, channels=None, callback=None, errback=None):
+        target = ','.join(channels) if channels else ''
+        return self.query('LIST', target, f'LIST {target}'.rstrip(), [], callback, errback)
+
+    def mode(self, channel, callback=None, errback=None):
+        return self.query('MODE', channel, f'MODE {channel}', {'channel': channel}, callback, errback)
+
+    def query(self, kind, target, line, result, callback, errback):
+        key = (kind, self.casefold(target))
+        query = self.pending.get(key)
+        if query is None:
+            cached = self.cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                self.hits += 1
+                self.cache.move_to_end(key)
+                query = Query(kind, target, key)
+                query.future.set_result(cached[1])  # Copied for the caller below.
+            else:
+                self.misses += 1
+                query = self.pending[key] = Query(kind, target, key)
+                query.result = result
+                query.timer = self.session.scheduler.call_later(self.timeout, self.expire, query)
+                self.session.sendline(line)
+
+        future = concurrent.futures.Future()
+        query.future.add_done_callback(lambda done: self.copy_result(done, future))
+        if callback or errback:
+            future.add_done_callback(lambda done: self.notify(done, callback, errback))
+        return future
+
+    @staticmethod
+    def copy_result(done, future):
+        """
+        Pass the outcome of a query on to the future of one caller.
+        """
+        if done.exception():
+            future.set_exception(done.exception())
+        else:
+            future.set_result(copy.deepcopy(done.result()))
+
+    def notify(self, future, callback, errback):
+        try:
+            if future.exception():
+                if errback:
+                    errback(future.exception())
+            elif callback:
+                callback(future.result())
+        except Exception as ex:
+            self.session.log.exception(ex)
+
+    def get(self, kind, target):
+        return self.pending.get((kind, self.casefold(target)))
+
+    def finish(self, query):
+        if self.pending.get(query.key) is not query:
+            return
+        del self.pending[query.key]
+        query.timer.cancel()
+        if query.error:
+            query.future.set_exception(QueryError(query.error))
+            return
+        self.cache[query.key] = (time.monotonic() + self.ttl, query.result)
+        self.cache.move_to_end(query.key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        query.future.set_result(query.result)
+
+    def expire(self, query):
+        if self.pending.get(query.key) is query:
+            del self.pending[query.key]
+            query.future.set_exception(TimeoutError(f'No reply to {query.kind} {query.target}'))
+
+    def fail_all(self, reason):
+        """
+        Called when the connection is lost, no replies will come anymore.
+        """
+        pending, self.pending = self.pending, {}
+        for query in pending.values():
+            query.timer.cancel()
+            query.future.set_exception(QueryError(reason))
+
+    def forget(self, kind, target):
+        self.cache.pop((kind, self.casefold(target)), None)
+
+    def handle(self, num, data):
+        """
+        Called with the numeric and its parameters after our own nickname.
+        """
+        if not self.pending or not data:
+            return
+        if num == LIST_REPLY or num == LIST_END:
+            # LIST replies do not say which request they answer, they come in the order we asked.
+            query = next((q for q in self.pending.values() if q.kind == 'LIST'), None)
+            if query and num == LIST_REPLY and len(data) > 2:
+                query.result.append((data[0], int(data[1]) if data[1].isdigit() else 0, trailing(data, 2)))
+            elif query and num == LIST_END:
+                self.finish(query)
+            return
+
+        target = data[0]
+        if num in WHOIS_REPLIES or num == WHOIS_END:
+            query = self.get('WHOIS', target)
+            if not query:
+                return
+            result = query.result
+            if num == 311 and len(data) > 4:
+                result.update(nick=target, ident=data[1], host=data[2], realname=trailing(data, 4))
+            elif num == 312 and len(data) > 1:
+                result['server'] = data[1]
+            elif num == 313:
+                result['operator'] = 1
+            elif num == 317 and len(data) > 2:
+                result['idle'] = int(data[1]) if data[1].isdigit() else None
+                result['signon'] = int(data[2]) if data[2].isdigit() else None
+            elif num == 319:
+                result['channels'] += trailing(data, 1).split()
+            elif num == 330 and len(data) > 1:
+                result['account'] = data[1]
+            elif num == 301:
+                result['away'] = trailing(data, 1)
+            elif num == 671:
+                result['secure'] = 1
+            elif num == WHOIS_END:
+                self.finish(query)
+
+        elif num == WHO_REPLY and len(data) > 6:
+            # A WHO for a channel is answered with that channel, a WHO for a mask with "*".
+            query = self.get('WHO', target) or next((q for q in self.pending.values() if q.kind == 'WHO'), None)
+            if query:
+                hops_realname = trailing(data, 6).split(' ', 1)
+                query.result.append({'channel': target, 'ident': data[1], 'host': data[2], 'server': data[3],
+                                     'nick': data[4], 'flags': data[5],
+                                     'realname': hops_realname[1] if len(hops_realname) > 1 else ''})
+        elif num == WHO_END:
+            query = self.get('WHO', target)
+            if query:
+                self.finish(query)
+
+        elif num == MODE_REPLY and len(data) > 1:
+            query = self.get('MODE', target)
+            if query:
+                query.result.update(modes=data[1], params=data[2:])
+                # RPL_CREATIONTIME usually follows in the same read, but not on every server.
+                self.session.scheduler.call_soon(self.finish, query)
+        elif num == MODE_CREATED and len(data) > 1:
+            query = self.get('MODE', target)
+            if query:
+                query.result['created'] = int(data[1]) if data[1].isdigit() else None
+
+        elif num in (NOSUCHNICK, NOSUCHSERVER, NOSUCHCHANNEL):
+            error = trailing(data, 1) or f'{num}'
+            query = self.get('WHOIS', target)
+            if query:
+                query.error = error  # RPL_ENDOFWHOIS follows.
+            query = self.get('MODE', target)
+            if query:
+                query.error = error
+                self.finish(query)
+
+    def stats(self):
+        return f'{len(self.pending)} queries waiting, {len(self.cache)} cached results, ' \
+               f'{self.hits} cache hits, {self.misses} sent.'
+
+    def __repr__(self):
+        return f'<QueryManager {self.session}>'
@@ -0,0 +1,215 @@
+"""
+Text triggers for modules.
+
+Besides commands, modules often react to text anywhere in a message: keywords, URLs and so on.
+Instead of testing every message themselves, modules register triggers:
+
+self.session.protocol.triggers.register(self, self.on_url, regex=r'https?://\\S+')
+self.session.protocol.triggers.register(self, self.on_keyword, literal='python', channels=['#bla'])
+
+The callback is called with the trigger and the match (the matched literal, or a re.Match object),
+while session.event_user_obj and session.event_target_obj point to the message as usual.
+
+All triggers are compiled together and every PRIVMSG is scanned only once:
+- literals go into one Aho-Corasick automaton, which finds all of them in a single pass;
+- regexes that require a literal (like "github" in r'github\.com/\S+') add that literal to the
+  automaton, and are only tested when it occurs in the message;
+- other regexes are combined into one alternation, so messages matching none of them cost a single
+  regex scan. Only when it matches are the individual regexes tested.
+Triggers of unloaded modules are removed automatically.
+"""
+
+import collections
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from utils.logger import logging
+
+
+class Trigger:
+    def __init__(self, owner, callback, literal=None, regex=None, channels=None, ignore_case=True):
+        self.owner = owner
+        self.callback = callback
+        self.literal = literal
+        self.ignore_case = ignore_case
+        flags = re.IGNORECASE if ignore_case else 0
+        self.regex = re.compile(regex, flags) if isinstance(regex, str) else regex
+        self.channels = {c.lower() for c in channels} if channels else None
+
+    def __repr__(self):
+        pattern = self.literal if self.literal is not None else self.regex.pattern
+        return f'<Trigger {pattern!r} for {self.owner}>'
+
+
+def required_literal(regex, minimum=3):
+    """
+    Returns the longest run of literal characters any match of `regex` must contain,
+    or None if there is no such run of at least `minimum` characters.
+    """
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    runs, run = [], ''
+    for op, value in parsed:
+        if op is sre_parse.LITERAL:
+            run += chr(value)
+        else:
+            runs.append(run)
+            run = ''
+    runs.append(run)
+    longest = max(runs, key=len)
+    return longest if len(longest) >= minimum else None
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton, finds all occurrences of many literals in one pass over the text.
+    """
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for word in words:
+            node = 0
+            for char in word:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                node = self.goto[node][char]
+            self.output[node].add(word)
+
+        # Breadth-first, so the fail link of every parent is known before its children.
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    def search(self, text):
+        """
+        Returns the set of words occurring in `text`.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found |= output[node]
+        return found
+
+
+class TriggerSet:
+    def __init__(self, log=logging):
+        self.triggers = []
+        self.log = log  # The logger of the session, the root logger if there is none.
+        self.compiled = 0
+
+    def register(self, owner, callback, literal=None, regex=None, channels=None, ignore_case=True):
+        """
+        :param owner:       the module object registering the trigger
+        :param callback:    called with (trigger, match) when the trigger matches
+        :param literal:     text to look for anywhere in the message
+        :param regex:       regex pattern (or compiled regex) to search for, instead of a literal
+        :param channels:    only trigger in these channels. None for everywhere, including private messages
+        :return:            Trigger object, pass it to unregister() to remove it
+        """
+        if (literal is None) == (regex is None):
+            raise ValueError("A trigger needs either a literal or a regex.")
+        if literal == '':
+            raise ValueError("A literal trigger can not be empty.")
+        trigger = Trigger(owner, callback, literal, regex, channels, ignore_case)
+        self.triggers.append(trigger)
+        self.compiled = 0
+        return trigger
+
+    def unregister(self, trigger):
+        if trigger in self.triggers:
+            self.triggers.remove(trigger)
+            self.compiled = 0
+
+    def unregister_owner(self, owner):
+        triggers = [t for t in self.triggers if t.owner is not owner]
+        if len(triggers) != len(self.triggers):
+            self.triggers = triggers
+            self.compiled = 0
+
+    def compile(self):
+        self.by_literal = collections.defaultdict(list)
+        for trigger in [t for t in self.triggers if t.literal is not None]:
+            self.by_literal[trigger.literal.lower()].append(trigger)
+        self.by_key = collections.defaultdict(list)
+        self.regexes = []  # Regex triggers without a required literal.
+        for trigger in [t for t in self.triggers if t.regex is not None]:
+            key = required_literal(trigger.regex)
+            if key:
+                self.by_key[key.lower()].append(trigger)
+            else:
+                self.regexes.append(trigger)
+        words = set(self.by_literal) | set(self.by_key)
+        self.automaton = Automaton(words) if words else None
+
+        self.combined = None
+        if self.regexes:
+            try:
+                self.combined = re.compile('|'.join(f'(?:{t.regex.pattern})' for t in self.regexes), re.IGNORECASE)
+            except re.error:
+                # Patterns using backreferences or duplicate group names can not be combined.
+                self.log.debug('Regex triggers can not be combined, testing them one by one.')
+        self.compiled = 1
+
+    def match(self, text, channel=None):
+        """
+        Returns a list of (trigger, match) for all triggers matching `text`.
+        """
+        if not self.triggers:
+            return []
+        if not self.compiled:
+            self.compile()
+
+        matches = []
+        if self.automaton:
+            for word in self.automaton.search(text.lower()):
+                for trigger in self.by_literal.get(word, ()):
+                    if trigger.ignore_case or trigger.literal in text:
+                        matches.append((trigger, trigger.literal))
+                for trigger in self.by_key.get(word, ()):
+                    found = trigger.regex.search(text)
+                    if found:
+                        matches.append((trigger, found))
+
+        if self.regexes and (not self.combined or self.combined.search(text)):
+            for trigger in self.regexes:
+                found = trigger.regex.search(text)
+                if found:
+                    matches.append((trigger, found))
+
+        channel = channel.lower() if channel else None
+        return [(t, m) for t, m in matches if t.channels is None or channel in t.channels]
+
+    def dispatch(self, text, channel=None):
+        for trigger, found in self.match(text, channel):
+            try:
+                trigger.callback(trigger, found)
+            except Exception as ex:
+                self.log.exception(ex)
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def __repr__(self):
+        return f'<TriggerSet {len(self.triggers)} triggers>'
@@ -0,0 +1,47 @@
+"""
+Token bucket rate limiter with a bounded amount of state.
+
+Every key (for example a hostmask and command) gets a bucket holding up to `burst` tokens,
+refilled at `rate` tokens per second. Every allowed call takes one token.
+Buckets are kept in an LRU table of at most `max_entries` keys, so memory stays bounded
+no matter how many different users pass by. An evicted key simply starts with a full bucket.
+"""
+
+import collections
+import time
+
+
+class RateLimiter:
+    def __init__(self, rate=0.5, burst=3, max_entries=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.buckets = collections.OrderedDict()  # key: [tokens, last update]
+        self.limited = 0
+
+    def allow(self, key):
+        """
+        Returns True and takes a token if `key` has one left, False otherwise.
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.limited += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __repr__(self):
+        return f'<RateLimiter rate={self.rate}/s burst={self.burst} ({len(self.buckets)} keys)>'
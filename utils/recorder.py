@@ -0,0 +1,125 @@
+"""
+Raw traffic recorder and replay engine.
+
+A recording is an append-only file holding the exact bytes received by a session,
+each chunk stamped with a monotonic offset from the start of the recording.
+Set `session.record = "<path>"` before starting a session to record its inbound traffic.
+
+File layout (little-endian):
+header:     8 bytes magic, double wall clock time of the start of the recording
+record:     double offset in seconds, uint32 length, <length> bytes of data
+
+Recordings are read through mmap, so large captures are not loaded into memory.
+They can be replayed through a session's protocol and modules without a socket:
+
+from utils import recorder
+stats = recorder.replay(session, "traffic.rec", realtime=False)
+"""
+
+import mmap
+import os
+import struct
+import time
+
+from utils.logger import logging
+
+MAGIC = b'SIFREC\x00\x01'
+HEADER = struct.Struct('<8sd')
+RECORD = struct.Struct('<dI')
+
+
+class RecordingError(Exception):
+    pass
+
+
+class TrafficRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        new = not os.path.exists(path) or not os.path.getsize(path)
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(HEADER.pack(MAGIC, time.time()))
+        else:
+            # Appending to an existing recording: continue after its last timestamp.
+            last = None
+            for last, _ in TrafficReader(path):
+                pass
+            if last is not None:
+                self.start -= last
+        self.bytes = 0
+        logging.info(f'Recording inbound traffic to {path}')
+
+    def write(self, data):
+        if not data or self.file.closed:
+            return
+        self.file.write(RECORD.pack(time.monotonic() - self.start, len(data)))
+        self.file.write(data)
+        self.file.flush()  # Keep the file usable if the process dies.
+        self.bytes += len(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            logging.info(f'Recording {self.path} closed, {self.bytes} bytes written.')
+
+    def __repr__(self):
+        return f'<TrafficRecorder {self.path}>'
+
+
+class TrafficReader:
+    """
+    Iterates over (offset, data) tuples of a recording.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.started = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise RecordingError(f'{path} is not a traffic recording.')
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos, size = HEADER.size, len(mm)
+                while pos + RECORD.size <= size:
+                    offset, length = RECORD.unpack_from(mm, pos)
+                    pos += RECORD.size
+                    if pos + length > size:
+                        logging.warning(f'Recording {self.path} ends with a truncated record, skipped.')
+                        break
+                    yield offset, mm[pos:pos + length]
+                    pos += length
+
+    def __repr__(self):
+        return f'<TrafficReader {self.path}>'
+
+
+def replay(session, path, realtime=False, speed=1.0):
+    """
+    Feed a recording through session.feed() and the protocol, as if it was received from the socket.
+    The session should not be started; an inactive session does not send anything.
+
+    :param session:     session object with a protocol
+    :param path:        path to the recording
+    :param realtime:    keep the original pace between chunks instead of going as fast as possible
+    :param speed:       pace multiplier when realtime is enabled
+    :return:            dict with replay statistics
+    """
+    chunks = total = 0
+    started = time.monotonic()
+    for offset, data in TrafficReader(path):
+        if realtime:
+            delay = offset / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+            session.scheduler.run_pending()
+        session.feed(data)
+        while session.scheduler.timeout(1.0) == 0:  # Let the protocol handle everything it queued.
+            session.scheduler.run_pending()
+        chunks += 1
+        total += len(data)
+
+    elapsed = time.monotonic() - started
+    logging.info(f'Replayed {chunks} chunks ({total} bytes) from {path} in {elapsed:.3f}s')
+    return {'chunks': chunks, 'bytes': total, 'elapsed': elapsed}
@@ -0,0 +1,249 @@
+"""
+Timer scheduler for sessions.
+
+Every session owns a Scheduler. Jobs are stored in a min-heap ordered by their due time,
+and the session's event loop uses Scheduler.timeout() as its select() timeout and calls
+Scheduler.run_pending() after every wake-up. This way modules can schedule work without
+starting threads of their own.
+
+Example, from within a module:
+
+self.job = self.session.scheduler.call_every(60, self.some_method)
+self.job.cancel()
+
+Jobs may be scheduled from any thread. If a new job becomes due before the loop would
+otherwise wake up, the loop is woken up through a socket pair.
+"""
+
+import datetime
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+from utils.logger import logging
+
+
+class Job:
+    """
+    A scheduled job. It also acts as the cancellation token for that job.
+    """
+    def __init__(self, scheduler, when, callback, args, kwargs, interval=None, cron=None):
+        self.scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.cron = cron
+        self.cancelled = 0
+
+    def cancel(self):
+        """
+        Cancel this job. Cancelled jobs are lazily removed from the heap once they come up.
+        """
+        self.cancelled = 1
+
+    def __repr__(self):
+        name = getattr(self.callback, '__qualname__', repr(self.callback))
+        kind = 'cron' if self.cron else 'interval' if self.interval else 'once'
+        return f'<Job {name} ({kind}) due in {self.when - time.monotonic():.2f}s>'
+
+
+class CronError(Exception):
+    pass
+
+
+class Cron:
+    """
+    Minimal cron expression: "minute hour day-of-month month day-of-week".
+    Every field accepts *, numbers, ranges (a-b), lists (a,b) and steps (*/n, a-b/n).
+    Day-of-week uses 0 for Sunday, like cron does.
+    """
+    fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise CronError(f"Cron expression needs 5 fields, got {len(parts)}: {expression}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [self.parse_field(part, low, high) for part, (low, high) in zip(parts, self.fields)]
+        # Like cron: if both day fields are restricted, either one may match.
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for item in field.split(','):
+            step = 1
+            if '/' in item:
+                item, step = item.split('/', 1)
+                step = int(step)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = (int(x) for x in item.split('-', 1))
+            else:
+                start = end = int(item)
+            if start < low or end > high or start > end or step < 1:
+                raise CronError(f"Invalid cron field: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, dt):
+        weekday = (dt.weekday() + 1) % 7  # Python uses 0 for Monday.
+        if self.any_day:
+            return weekday in self.weekdays
+        if self.any_weekday:
+            return dt.day in self.days
+        return dt.day in self.days or weekday in self.weekdays
+
+    def next_after(self, dt):
+        """
+        Returns the first datetime after `dt` matching this expression.
+        """
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+            if not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            if dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+                continue
+            return dt
+        raise CronError(f"Cron expression never matches: {self.expression}")
+
+    def __repr__(self):
+        return f'<Cron "{self.expression}">'
+
+
+class Scheduler:
+    def __init__(self, log=logging):
+        self.heap = []
+        self.log = log  # The logger of the session, the root logger if there is none.
+        self.lock = threading.Lock()
+        self.counter = itertools.count()  # Tie-breaker for jobs due at the same time.
+        self.thread = None  # Thread running this scheduler, set by run_pending().
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def _push(self, job):
+        with self.lock:
+            heapq.heappush(self.heap, (job.when, next(self.counter), job))
+            earliest = self.heap[0][2] is job
+        if earliest and threading.current_thread() is not self.thread:
+            self.wakeup()
+        return job
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """
+        Run `callback` once, after `delay` seconds.
+        """
+        return self._push(Job(self, time.monotonic() + delay, callback, args, kwargs))
+
+    def call_soon(self, callback, *args, **kwargs):
+        """
+        Run `callback` on the next loop iteration. Safe to call from other threads.
+        """
+        return self.call_later(0, callback, *args, **kwargs)
+
+    def call_every(self, interval, callback, *args, first=None, **kwargs):
+        """
+        Run `callback` every `interval` seconds. The first run happens after `first` seconds,
+        which defaults to `interval`.
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be greater than 0.")
+        first = interval if first is None else first
+        return self._push(Job(self, time.monotonic() + first, callback, args, kwargs, interval=interval))
+
+    def call_cron(self, expression, callback, *args, **kwargs):
+        """
+        Run `callback` whenever the cron expression matches the local wall clock.
+        """
+        cron = Cron(expression)
+        return self._push(Job(self, self._cron_due(cron), callback, args, kwargs, cron=cron))
+
+    @staticmethod
+    def _cron_due(cron):
+        now = datetime.datetime.now()
+        return time.monotonic() + (cron.next_after(now) - now).total_seconds()
+
+    def timeout(self, maximum=None):
+        """
+        Seconds until the next job is due, capped at `maximum`.
+        """
+        with self.lock:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return maximum
+            delay = max(0.0, self.heap[0][0] - time.monotonic())
+        return delay if maximum is None else min(delay, maximum)
+
+    def run_pending(self):
+        """
+        Run all jobs that are due. Called from the session's event loop.
+        """
+        self.thread = threading.current_thread()
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[2])
+
+        for job in [job for job in due if not job.cancelled]:
+            try:
+                job.callback(*job.args, **job.kwargs)
+            except Exception as ex:
+                self.log.exception(ex)
+
+            if job.cancelled:
+                continue
+            if job.interval:
+                # Schedule relative to the planned time so intervals do not drift.
+                job.when = max(job.when + job.interval, now)
+                self._push(job)
+            elif job.cron:
+                job.when = self._cron_due(job.cron)
+                self._push(job)
+
+    def pending(self):
+        with self.lock:
+            return [job for _, _, job in sorted(self.heap) if not job.cancelled]
+
+    def wakeup(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Buffer full means a wake-up is already pending.
+
+    def clear_wakeup(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def cancel_all(self):
+        with self.lock:
+            for _, _, job in self.heap:
+                job.cancel()
+            self.heap = []
+
+    def fileno(self):
+        return self._wake_r.fileno()
+
+    def __repr__(self):
+        return f'<Scheduler ({len(self.heap)} jobs)>'
@@ -29,14 +29,28 @@ def check_settings(session):
 
 
     # Checking optional attributes.
-    optional_attributes = {"channel": str, "alt_nick": str, "cert": str}
+    optional_attributes = {"channel": str, "alt_nick": str, "cert": str, "record": str,
+                           "slow_threshold": (int, float),
+                           "inbound_limit": int, "shed_above": int, "shed_policy": str, "shed_sample_rate": int,
+                           "command_rate": (int, float), "command_burst": int, "ignore": list,
+                           "state_check_interval": int, "ping_interval": int, "stall_timeout": int,
+                           "reconnect_delay": int, "log_level": str, "log_file": str, "raw_log": str,
+                           "raw_sample": int, "query_ttl": int, "autojoin": list}
     for attr in [attr for attr in session.__dict__.keys() if attr in optional_attributes]:
         is_type = type(getattr(session, attr))
         req_type = optional_attributes[str(attr)]
-        if is_type != req_type:
+        if is_type not in (req_type if isinstance(req_type, tuple) else (req_type,)):
             error = f"Wrong type for optional attribute {attr}: {is_type} != {req_type}"
             raise IRCSettingsError(error)
 
+    if hasattr(session, 'shed_policy') and session.shed_policy not in ['drop', 'sample']:
+        error = f"Invalid shed_policy: {session.shed_policy}. Choose either 'drop' or 'sample'."
+        raise IRCSettingsError(error)
+
+    if hasattr(session, 'raw_log') and session.raw_log not in ['all', 'sample', 'errors', 'off']:
+        error = f"Invalid raw_log: {session.raw_log}. Choose 'all', 'sample', 'errors' or 'off'."
+        raise IRCSettingsError(error)
+
     if hasattr(session, 'cert'):
         if not os.path.isfile(session.cert):
             error = f"You provied a TLS cert, but the file could not be found: {session.cert}"